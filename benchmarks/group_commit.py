@@ -0,0 +1,83 @@
+"""
+Benchmark of the booking throughput and latency with and without group commit, on a file SQLite database (so each commit
+pays an fsync), with concurrent clients booking distinct slots through the create_appointment endpoint.
+
+Run it from the root of the repository with:
+    python -m benchmarks.group_commit [--bookings 2000] [--clients 32] [--windows 1 2 5 10 20]
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import os
+import statistics
+import tempfile
+import time as timer
+
+from src.app import create_app
+
+
+def distinct_slots(count):
+    """ Yield (doctor_id, start_time) of distinct 30 minutes slots inside the working hours of the default doctors """
+    day = datetime(2030, 1, 7)  # A Monday
+    while True:
+        if day.weekday() < 5:
+            for doctor_id, first_hour in ((1, 9), (2, 8)):  # Dr Strange works from 9:00, Dr Who from 8:00, both for 8 hours
+                for slot in range(16):
+                    if count == 0:
+                        return
+                    yield doctor_id, day + timedelta(hours=first_hour, minutes=30 * slot)
+                    count -= 1
+        day += timedelta(days=1)
+
+
+def run(bookings, clients, window_ms=None):
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(config={
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(directory, "db.sqlite")}',
+            # Without group commit concurrent writers wait on the database lock instead of failing
+            'SQLALCHEMY_ENGINE_OPTIONS': {'connect_args': {'timeout': 60}},
+            'GROUP_COMMIT_ENABLED': window_ms is not None,
+            'GROUP_COMMIT_MAX_BATCH_SIZE': clients,
+            'GROUP_COMMIT_WINDOW_MS': window_ms or 0,
+        })
+
+        def book(slot):
+            doctor_id, start_time = slot
+            started_at = timer.perf_counter()
+            with app.test_client() as client:
+                response = client.post(f'/doctors/{doctor_id}/appointments', json={
+                    'appointment_starts_at': start_time.isoformat(),
+                    'appointment_ends_at': (start_time + timedelta(minutes=30)).isoformat(),
+                })
+            assert response.status_code == 201, response.json
+            return timer.perf_counter() - started_at
+
+        started_at = timer.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            latencies = sorted(executor.map(book, distinct_slots(bookings)))
+        elapsed = timer.perf_counter() - started_at
+
+        if window_ms is not None:
+            app.extensions['group_commit'].close()
+        return bookings / elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bookings', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--windows', type=float, nargs='+', default=[1, 2, 5, 10, 20], help='Group commit windows in milliseconds')
+    args = parser.parse_args()
+
+    print(f'{args.bookings} bookings from {args.clients} concurrent clients')
+    print(f'{"mode":<24}{"bookings/sec":>14}{"p50 ms":>10}{"p99 ms":>10}')
+    for window_ms in [None, *args.windows]:
+        throughput, latencies = run(args.bookings, args.clients, window_ms)
+        mode = 'commit per booking' if window_ms is None else f'group commit {window_ms:g}ms'
+        p50 = statistics.median(latencies) * 1000
+        p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+        print(f'{mode:<24}{throughput:>14.0f}{p50:>10.1f}{p99:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
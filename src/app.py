@@ -1,11 +1,14 @@
 from datetime import time
 from flask import Flask
+from sqlalchemy.pool import StaticPool
+from src.commands import import_appointments_command, import_working_hours_command
 from src.extensions import db
 from src.endpoints import base
+from src.group_commit import GroupCommitter
 from src.models import Doctor, WorkingHours
 
 
-def populate_db():
+def populate_database():
     doctor_strange = Doctor(name='Strange')
     db.session.add(doctor_strange)
     doctor_who = Doctor(name='Who')
@@ -17,16 +20,36 @@ def populate_db():
     db.session.commit()
 
 
-def create_app(populate_db=True):
+def create_app(populate_db=True, config=None):
     app = Flask(__name__)
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+    # Group commit batches concurrent bookings in a single transaction, see src/group_commit.py
+    app.config['GROUP_COMMIT_ENABLED'] = False
+    app.config['GROUP_COMMIT_MAX_BATCH_SIZE'] = 64
+    app.config['GROUP_COMMIT_WINDOW_MS'] = 5
+    app.config['GROUP_COMMIT_TIMEOUT_SECONDS'] = 5  # A request waiting longer for its batch gets a 503
+    # Any setting can be overridden with a FLASK_ prefixed environment variable, i.e. FLASK_SQLALCHEMY_DATABASE_URI, so the
+    # server and the CLI commands (each running in its own process) can share a file database
+    app.config.from_prefixed_env()
+    app.config.update(config or {})
     db.init_app(app)
-    # We are doing a create all here to set up all the tables. Because we are using an in memory sqllite db, each
+    # We are doing a create all here to set up all the tables. By default we are using an in memory sqllite db, so each
     # restart wipes the db clean, but does have the advantage of not having to worry about schema migrations.
     with app.app_context():
         db.create_all()
-        if populate_db:
-            populate_db()
+        if populate_db and not Doctor.query.first():  # A file database is only populated the first time
+            populate_database()
 
     app.register_blueprint(base)
+    if app.config['GROUP_COMMIT_ENABLED']:
+        # The worker thread commits on its own connection. An in memory database lives in a single connection shared by every
+        # thread, so a request rolling back its session would also roll back the worker's batch.
+        with app.app_context():
+            if isinstance(db.engine.pool, StaticPool) or db.engine.url.database in (None, '', ':memory:'):
+                raise ValueError('GROUP_COMMIT_ENABLED requires a database each thread can open its own connection to, not an in memory one')
+        app.extensions['group_commit'] = GroupCommitter(
+            app, max_batch_size=app.config['GROUP_COMMIT_MAX_BATCH_SIZE'], window_ms=app.config['GROUP_COMMIT_WINDOW_MS']
+        )
+    app.cli.add_command(import_appointments_command)
+    app.cli.add_command(import_working_hours_command)
     return app
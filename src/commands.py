@@ -0,0 +1,57 @@
+import json
+import os
+import time as timer
+
+import click
+from flask.cli import with_appcontext
+
+from src.importers import import_appointments, import_working_hours, read_records
+
+
+def import_options(f):
+    f = click.argument('input_file', type=click.File('r'))(f)
+    f = click.option(
+        '--format', 'input_format', type=click.Choice(['csv', 'ndjson']), default=None,
+        help='Format of the input file, guessed from its extension if not specified.'
+    )(f)
+    f = click.option('--chunk-size', type=click.IntRange(min=1), default=10000, show_default=True, help='Rows validated and committed together.')(f)
+    f = click.option('--rejects', 'rejects_file', type=click.File('w'), default=None, help='Write the rejected rows and the reason as NDJSON.')(f)
+    return f
+
+
+def run_import(importer, input_file, input_format, chunk_size, rejects_file):
+    if input_format is None:
+        input_format = 'csv' if os.path.splitext(input_file.name)[1].lower() == '.csv' else 'ndjson'
+
+    imported = rejected = 0
+    started_at = timer.perf_counter()
+    for chunk_imported, chunk_rejects in importer(read_records(input_file, input_format), chunk_size):
+        imported += chunk_imported
+        rejected += len(chunk_rejects)
+        if rejects_file:
+            for line_number, record, error in chunk_rejects:
+                rejects_file.write(json.dumps({'line': line_number, 'row': record, 'error': error}) + '\n')
+
+        elapsed = timer.perf_counter() - started_at
+        click.echo(f'{imported} imported, {rejected} rejected ({(imported + rejected) / elapsed:.0f} rows/sec)', err=True)
+
+    click.echo(f'Done: {imported} imported, {rejected} rejected in {timer.perf_counter() - started_at:.1f}s')
+
+
+@click.command('import-appointments')
+@import_options
+@with_appcontext
+def import_appointments_command(input_file, input_format, chunk_size, rejects_file):
+    """
+    Bulk import appointments from a CSV or NDJSON file with doctor_id, start_time, end_time and (optionally) notes.
+    Rows outside working hours or conflicting with existing appointments (or with each other) are rejected.
+    """
+    run_import(import_appointments, input_file, input_format, chunk_size, rejects_file)
+
+
+@click.command('import-working-hours')
+@import_options
+@with_appcontext
+def import_working_hours_command(input_file, input_format, chunk_size, rejects_file):
+    """ Bulk import working hours from a CSV or NDJSON file with doctor_id, day_of_the_week, start_time and end_time """
+    run_import(import_working_hours, input_file, input_format, chunk_size, rejects_file)
@@ -1,11 +1,20 @@
-from datetime import timedelta
-from flask import Blueprint, jsonify
+from concurrent import futures
+from datetime import datetime, timedelta
+from flask import Blueprint, Response, current_app, jsonify, request
 from http import HTTPStatus
+from typing import List, Optional, Tuple
 from src import errors
-from src.extensions import db
-from src.helpers import brute_force_approach, find_earliest_available_slot
+from src.extensions import events
+from src.group_commit import GroupCommitter, GroupCommitterStopped
+from src.helpers import (
+    MAX_SUMMARY_WINDOW_DAYS, SUMMARY_GRANULARITIES, book_appointments, brute_force_approach, find_earliest_available_slot, find_earliest_joint_slot,
+    find_earliest_series_slot, find_schedule_error, find_time_error, load_busy_intervals, series_starts, summarize_availability,
+    working_intervals_by_day
+)
+from src.intervals import Interval
 from src.models import Appointment, Doctor, WorkingHours
-from webargs import fields
+from sqlalchemy.orm import selectinload
+from webargs import fields, validate
 from webargs.flaskparser import use_kwargs
 
 base = Blueprint('/', __name__)
@@ -21,13 +30,23 @@ def health_check():
     return {'status': 'OK'}
 
 
+# Every timestamp is naive (see the README), an offset would make them impossible to compare with the stored ones
+def validate_naive_datetimes(f):
+    def wrapper(*args, **kwargs):
+        if any(isinstance(value, datetime) and value.tzinfo is not None for value in kwargs.values()):
+            return jsonify({'error': errors.TIMEZONE_AWARE_DATETIME_ERROR}), HTTPStatus.BAD_REQUEST
+        return f(*args, **kwargs)
+    wrapper.__name__ = f.__name__
+    return wrapper
+
+
 # create a decorator function that validates the doctor_id and returns a 404 if the doctor is not found
 # https://flask.palletsprojects.com/en/2.0.x/patterns/viewdecorators/
 def validate_doctor_id(f):
     def wrapper(doctor_id, *args, **kwargs):
         doctor = Doctor.query.get(doctor_id)
         if not doctor:
-            return jsonify({'error': 'Doctor not found'}), HTTPStatus.NOT_FOUND
+            return jsonify({'error': errors.DOCTOR_NOT_FOUND_ERROR}), HTTPStatus.NOT_FOUND
         return f(doctor, *args, **kwargs)
     wrapper.__name__ = f.__name__
     return wrapper
@@ -38,6 +57,7 @@ def validate_doctor_id(f):
     'start_time': fields.DateTime(required=True), 
     'end_time': fields.DateTime(required=True)
 }, location="querystring")
+@validate_naive_datetimes
 @validate_doctor_id
 def get_appointments(doctor, start_time, end_time):
     """ Get all appointments for a doctor between a start and end time """
@@ -61,65 +81,163 @@ def get_appointments(doctor, start_time, end_time):
     'appointment_ends_at': fields.DateTime(required=True),
     'notes': fields.String(required=False)
 }, location="json")
+@validate_naive_datetimes
 @validate_doctor_id
 def create_appointment(doctor, appointment_starts_at, appointment_ends_at, notes=None):
     """ Create an appointment for a doctor between a start and end time, return error if there's a conflict """  
-    
-    # This is an assumption, but I think it's a reasonable one.
-    if appointment_starts_at.date() != appointment_ends_at.date():
-        return jsonify({'error': errors.CANNOT_CREATE_APPOINTMENT_ON_DIFFERENT_DAYS_ERROR}), HTTPStatus.BAD_REQUEST
-    
-    if appointment_starts_at >= appointment_ends_at:
-        return jsonify({'error': errors.CANNOT_CREATE_APPOINTMENT_WRONG_TIME_ORDER_ERROR}), HTTPStatus.BAD_REQUEST
-
-    # A conflit can happen in the following cases:
-    # - New appointment inside an existing appointment (edge case new appointment starts and ends at the same time as an existing appointment)
-    # - New appointment starts before an existing appointment and ends inside it
-    # - New appointment starts inside an existing appointment and ends after it
-    # - New appointment starts before an existing appointment and ends after it
-
-    # Check if we are trying to create an appointment inside an existing appointment
-    conflict = Appointment.query.filter_by(doctor_id=doctor.id).filter(
-        Appointment.start_time < appointment_ends_at,
-        Appointment.end_time > appointment_starts_at
-    ).first()
-
-    if conflict:
-        return jsonify({'error': errors.CANNOT_CREATE_APPOINTMENT_CONFLIT_ERROR}), HTTPStatus.CONFLICT
-
-    # Check if we are trying to create an appointment outside of working hours  
-    working_hours = (
+    if group_committer := current_app.extensions.get('group_commit'):
+        return book_with_group_commit(group_committer, doctor.id, appointment_starts_at, appointment_ends_at, notes)
+
+    if error := check_appointments(doctor.id, [(appointment_starts_at, appointment_ends_at)]):
+        _, message, status = error
+        return jsonify({'error': message}), status
+
+    [appointment] = book_appointments([(doctor.id, (appointment_starts_at, appointment_ends_at), notes)])
+    return jsonify(appointment), HTTPStatus.CREATED
+
+
+@base.route('/doctors/<int:doctor_id>/appointments/series', methods=['POST'])
+@use_kwargs({
+    'appointment_starts_at': fields.DateTime(required=True),  # Of the first occurrence
+    'appointment_ends_at': fields.DateTime(required=True),
+    'occurrences': fields.Int(required=True, validate=validate.Range(min=1, max=Appointment.MAX_SERIES_OCCURRENCES)),
+    'interval_days': fields.Int(load_default=7, validate=validate.Range(min=1)),  # Weekly by default
+    'notes': fields.String(required=False)
+}, location="json")
+@validate_naive_datetimes
+@validate_doctor_id
+def create_appointment_series(doctor, appointment_starts_at, appointment_ends_at, occurrences, interval_days, notes=None):
+    """ Create every occurrence of a recurring appointment in a single transaction, none of them is created if any has an error """
+    if error := validate_series(occurrences, interval_days):
+        return error
+
+    appointment_length = appointment_ends_at - appointment_starts_at
+    appointments = [(start, start + appointment_length) for start in series_starts(appointment_starts_at, occurrences, timedelta(days=interval_days))]
+    if error := check_appointments(doctor.id, appointments):
+        occurrence_start_time, message, status = error
+        return jsonify({'error': message, 'occurrence_start_time': occurrence_start_time.isoformat()}), status
+
+    return jsonify(book_appointments([(doctor.id, appointment, notes) for appointment in appointments])), HTTPStatus.CREATED
+
+
+def validate_series(occurrences, interval_days):
+    if occurrences * interval_days > Appointment.MAX_SERIES_SPAN_DAYS:
+        return jsonify({'error': errors.SERIES_TOO_LONG_ERROR.format(max_days=Appointment.MAX_SERIES_SPAN_DAYS)}), HTTPStatus.BAD_REQUEST
+    return None
+
+
+def book_with_group_commit(
+    group_committer: GroupCommitter, doctor_id: int, appointment_starts_at: datetime, appointment_ends_at: datetime, notes: Optional[str]
+):
+    """ Same as create_appointment, through the group committer. A 503 means the appointment isn't booked, unless the error says otherwise """
+    timeout = current_app.config['GROUP_COMMIT_TIMEOUT_SECONDS']
+    try:
+        future = group_committer.submit(doctor_id, appointment_starts_at, appointment_ends_at, notes)
+        try:
+            appointment, error = future.result(timeout=timeout)
+        except futures.TimeoutError:
+            # The worker is stuck or too slow, don't let the requests pile up waiting for it. A booking still queued is
+            # cancelled, so it's never committed and the client can safely retry.
+            if future.cancel():
+                return jsonify({'error': errors.CANNOT_CREATE_APPOINTMENT_UNAVAILABLE_ERROR}), HTTPStatus.SERVICE_UNAVAILABLE
+            # The worker already started processing it, its outcome is about to be known
+            appointment, error = future.result(timeout=timeout)
+    except GroupCommitterStopped:
+        return jsonify({'error': errors.CANNOT_CREATE_APPOINTMENT_UNAVAILABLE_ERROR}), HTTPStatus.SERVICE_UNAVAILABLE
+    except futures.TimeoutError:
+        return jsonify({'error': errors.CANNOT_CONFIRM_APPOINTMENT_ERROR}), HTTPStatus.SERVICE_UNAVAILABLE
+    except (TypeError, ValueError):
+        # The worker couldn't process this booking, even on its own
+        current_app.logger.exception('Invalid booking')
+        return jsonify({'error': errors.CANNOT_PROCESS_APPOINTMENT_ERROR}), HTTPStatus.BAD_REQUEST
+    except Exception:
+        # i.e. the database failed to commit it, it was rolled back so it can be retried
+        current_app.logger.exception('Booking failed')
+        return jsonify({'error': errors.CANNOT_CREATE_APPOINTMENT_UNAVAILABLE_ERROR}), HTTPStatus.SERVICE_UNAVAILABLE
+
+    if error:
+        return jsonify({'error': error}), BOOKING_ERROR_STATUSES.get(error, HTTPStatus.BAD_REQUEST)
+    return jsonify(appointment), HTTPStatus.CREATED
+
+
+# Any other booking error is a bad request
+BOOKING_ERROR_STATUSES = {errors.CANNOT_CREATE_APPOINTMENT_CONFLIT_ERROR: HTTPStatus.CONFLICT}
+
+
+def check_appointments(doctor_id: int, appointments: List[Interval]) -> Optional[Tuple[datetime, str, HTTPStatus]]:
+    """ Check the appointments can be booked for the doctor, return the start of the first invalid one with the error and status code """
+    for appointment in appointments:
+        if error := find_time_error(appointment):
+            return appointment[0], error, BOOKING_ERROR_STATUSES.get(error, HTTPStatus.BAD_REQUEST)
+
+    # The existing appointments and the working hours are loaded once for all the appointments, with a query each
+    busy = load_busy_intervals(
+        [doctor_id], min(start for start, _ in appointments), max(end for _, end in appointments)
+    )[doctor_id]
+    working_hours = working_intervals_by_day(
         WorkingHours.query
-        .filter_by(doctor_id=doctor.id)
-        .filter(
-            WorkingHours.day_of_the_week == appointment_starts_at.weekday(),
-        ).first()
+        .filter_by(doctor_id=doctor_id)
+        .filter(WorkingHours.day_of_the_week.in_({start.weekday() for start, _ in appointments}))
+        .all()
     )
-    if working_hours is None: # Doctor is not working on the day of the appointment
-        return jsonify({'error': errors.CANNOT_CREATE_APPOINTMENT_OUTSIDE_WORKING_HOURS_ERROR}), HTTPStatus.BAD_REQUEST
 
-    # Appointment is outside working hours if it starts before the start time or ends after the end time
-    if appointment_starts_at.time() < working_hours.start_time or appointment_ends_at.time() > working_hours.end_time: 
-        return jsonify({'error': errors.CANNOT_CREATE_APPOINTMENT_OUTSIDE_WORKING_HOURS_ERROR}), HTTPStatus.BAD_REQUEST
-    
-    new_appointment = Appointment(
-        start_time=appointment_starts_at,
-        end_time=appointment_ends_at,
-        doctor_id=doctor.id,
-        notes=notes
-    )
-    db.session.add(new_appointment)
-    db.session.commit()
-    return jsonify(new_appointment.to_dict()), HTTPStatus.CREATED
+    for appointment in appointments:
+        if error := find_schedule_error(appointment, busy, working_hours):
+            return appointment[0], error, BOOKING_ERROR_STATUSES.get(error, HTTPStatus.BAD_REQUEST)
+
+    return None
+
+
+@base.route('/appointments/joint', methods=['POST'])
+@use_kwargs({
+    'doctor_ids': fields.List(fields.Int(), required=True, validate=validate.Length(min=1)),
+    'appointment_starts_at': fields.DateTime(required=True),
+    'appointment_ends_at': fields.DateTime(required=True),
+    'notes': fields.String(required=False)
+}, location="json")
+@validate_naive_datetimes
+def create_joint_appointment(doctor_ids, appointment_starts_at, appointment_ends_at, notes=None):
+    """ Create the same appointment with several doctors in a single transaction, none of them is created if any has an error """
+    doctors = find_doctors(doctor_ids)
+    if doctors is None:
+        return jsonify({'error': errors.DOCTOR_NOT_FOUND_ERROR}), HTTPStatus.NOT_FOUND
+
+    appointment = (appointment_starts_at, appointment_ends_at)
+    if error := find_time_error(appointment):
+        return jsonify({'error': error}), BOOKING_ERROR_STATUSES.get(error, HTTPStatus.BAD_REQUEST)
+
+    # The existing appointments of all the doctors are loaded with a single query, their working hours with the doctors
+    busy = load_busy_intervals([doctor.id for doctor in doctors], *appointment)
+    for doctor in doctors:
+        if error := find_schedule_error(appointment, busy[doctor.id], working_intervals_by_day(doctor.working_hours)):
+            return jsonify({'error': error, 'doctor_id': doctor.id}), BOOKING_ERROR_STATUSES.get(error, HTTPStatus.BAD_REQUEST)
+
+    return jsonify(book_appointments([(doctor.id, (appointment_starts_at, appointment_ends_at), notes) for doctor in doctors])), HTTPStatus.CREATED
+
+
+def find_doctors(doctor_ids: List[int]) -> Optional[List[Doctor]]:
+    """ Load the doctors, sorted by id, along with their working hours. Return None if any of them doesn't exist """
+    doctors = Doctor.query.options(selectinload(Doctor.working_hours)).filter(Doctor.id.in_(doctor_ids)).order_by(Doctor.id).all()
+    return doctors if len(doctors) == len(set(doctor_ids)) else None
 
 
 @base.route('/appointments/first_available', methods=['GET'])
 @use_kwargs({
     'start_time': fields.DateTime(required=True),
-    'appointment_length_minutes': fields.Int(load_default=30, validate=lambda x: 0 < x <= Appointment.MAX_APPOINMENT_LENGTH)  # Default to 30 minutes if not specified
+    'appointment_length_minutes': fields.Int(load_default=30, validate=lambda x: 0 < x <= Appointment.MAX_APPOINMENT_LENGTH),  # Default to 30 minutes if not specified
+    'doctor_ids': fields.List(fields.Int(), load_default=list),  # If specified, all of these doctors are required at the same time
 }, location="querystring")
-def get_first_available_appointment(start_time, appointment_length_minutes):
-    doctors = Doctor.query.join(WorkingHours).all()  # Get all doctors that have working hours
+@validate_naive_datetimes
+def get_first_available_appointment(start_time, appointment_length_minutes, doctor_ids):
+    if doctor_ids:
+        return get_first_available_joint_appointment(start_time, appointment_length_minutes, doctor_ids)
+
+    # Get all doctors that have working hours, loading their working hours and appointments upfront to avoid two queries per doctor
+    doctors = (
+        Doctor.query.join(WorkingHours)
+        .options(selectinload(Doctor.working_hours), selectinload(Doctor.appointments))
+        .all()
+    )
     
     # earliest_available, earliest_available_doctor_id = brute_force_approach(doctors, start_time, appointment_length_minutes)
     earliest_available, earliest_available_doctor_id = find_earliest_available_slot(doctors, start_time, appointment_length_minutes)
@@ -132,4 +250,125 @@ def get_first_available_appointment(start_time, appointment_length_minutes):
         })
 
     return jsonify({'error': errors.CANNOT_FIND_AVAILABLE_APPOINTMENT_ERROR}), HTTPStatus.NOT_FOUND
-        
\ No newline at end of file
+
+
+def get_first_available_joint_appointment(start_time, appointment_length_minutes, doctor_ids):
+    doctors = find_doctors(doctor_ids)
+    if doctors is None:
+        return jsonify({'error': errors.DOCTOR_NOT_FOUND_ERROR}), HTTPStatus.NOT_FOUND
+
+    earliest_available = find_earliest_joint_slot(doctors, start_time, appointment_length_minutes)
+    if earliest_available:
+        return jsonify({
+            'start_time': earliest_available.isoformat(),
+            'end_time': (earliest_available + timedelta(minutes=appointment_length_minutes)).isoformat(),
+            'doctor_ids': [doctor.id for doctor in doctors]
+        })
+
+    return jsonify({'error': errors.CANNOT_FIND_AVAILABLE_APPOINTMENT_ERROR}), HTTPStatus.NOT_FOUND
+
+
+def validate_summary_window(start_time, end_time):
+    if start_time >= end_time:
+        return jsonify({'error': errors.INVALID_TIME_WINDOW_ERROR}), HTTPStatus.BAD_REQUEST
+    if end_time - start_time > timedelta(days=MAX_SUMMARY_WINDOW_DAYS):
+        return jsonify({'error': errors.TIME_WINDOW_TOO_LARGE_ERROR.format(max_days=MAX_SUMMARY_WINDOW_DAYS)}), HTTPStatus.BAD_REQUEST
+    return None
+
+
+availability_summary_args = {
+    'start_time': fields.DateTime(required=True, data_key='from'),
+    'end_time': fields.DateTime(required=True, data_key='to'),
+    'granularity': fields.String(load_default='day', validate=validate.OneOf(list(SUMMARY_GRANULARITIES))),
+}
+
+
+@base.route('/doctors/<int:doctor_id>/availability_summary', methods=['GET'])
+@use_kwargs(availability_summary_args, location="querystring")
+@validate_naive_datetimes
+@validate_doctor_id
+def get_availability_summary(doctor, start_time, end_time, granularity):
+    """ Get the free minutes, longest free gap and booked ratio for each day (or hour) between two dates """
+    if error := validate_summary_window(start_time, end_time):
+        return error
+
+    appointments = load_busy_intervals([doctor.id], start_time, end_time)[doctor.id]
+    return jsonify({
+        'doctor_id': doctor.id,
+        'granularity': granularity,
+        'summary': summarize_availability(doctor.working_hours, appointments, start_time, end_time, granularity),
+    }), HTTPStatus.OK
+
+
+@base.route('/doctors/availability_summary', methods=['GET'])
+@use_kwargs({
+    **availability_summary_args,
+    'doctor_ids': fields.List(fields.Int(), load_default=list),  # All the doctors if not specified
+}, location="querystring")
+@validate_naive_datetimes
+def get_doctors_availability_summary(start_time, end_time, granularity, doctor_ids):
+    """ Same as get_availability_summary, but for several doctors at once """
+    if error := validate_summary_window(start_time, end_time):
+        return error
+
+    if doctor_ids:
+        doctors = find_doctors(doctor_ids)
+        if doctors is None:
+            return jsonify({'error': errors.DOCTOR_NOT_FOUND_ERROR}), HTTPStatus.NOT_FOUND
+    else:
+        doctors = Doctor.query.options(selectinload(Doctor.working_hours)).order_by(Doctor.id).all()
+
+    busy = load_busy_intervals([doctor.id for doctor in doctors], start_time, end_time)
+    return jsonify([
+        {
+            'doctor_id': doctor.id,
+            'granularity': granularity,
+            'summary': summarize_availability(doctor.working_hours, busy[doctor.id], start_time, end_time, granularity),
+        }
+        for doctor in doctors
+    ]), HTTPStatus.OK
+
+
+@base.route('/events', methods=['GET'])
+@use_kwargs({
+    'doctor_id': fields.Int(required=False),  # All the doctors if not specified
+}, location="querystring")
+def stream_events(doctor_id=None):
+    """ Server-Sent Events stream of the booking changes, so clients can keep their caches up to date instead of polling """
+    # Browsers send the id of the last event they received when reconnecting
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    return Response(
+        events.subscribe(last_event_id, doctor_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+@base.route('/doctors/<int:doctor_id>/appointments/first_available_series', methods=['GET'])
+@use_kwargs({
+    'start_time': fields.DateTime(required=True),
+    'appointment_length_minutes': fields.Int(load_default=30, validate=lambda x: 0 < x <= Appointment.MAX_APPOINMENT_LENGTH),
+    'occurrences': fields.Int(required=True, validate=validate.Range(min=1, max=Appointment.MAX_SERIES_OCCURRENCES)),
+    'interval_days': fields.Int(load_default=7, validate=validate.Range(min=1)),  # Weekly by default
+}, location="querystring")
+@validate_naive_datetimes
+@validate_doctor_id
+def get_first_available_series(doctor, start_time, appointment_length_minutes, occurrences, interval_days):
+    """ Get the earliest start time at which every occurrence of a recurring appointment is available with the doctor """
+    if error := validate_series(occurrences, interval_days):
+        return error
+
+    earliest_available = find_earliest_series_slot(doctor, start_time, appointment_length_minutes, occurrences, interval_days)
+    if not earliest_available:
+        return jsonify({'error': errors.CANNOT_FIND_AVAILABLE_APPOINTMENT_ERROR}), HTTPStatus.NOT_FOUND
+
+    appointment_length = timedelta(minutes=appointment_length_minutes)
+    return jsonify({
+        'start_time': earliest_available.isoformat(),
+        'end_time': (earliest_available + appointment_length).isoformat(),
+        'doctor_id': doctor.id,
+        'occurrences': [
+            {'start_time': start.isoformat(), 'end_time': (start + appointment_length).isoformat()}
+            for start in series_starts(earliest_available, occurrences, timedelta(days=interval_days))
+        ],
+    })
@@ -2,4 +2,12 @@ CANNOT_CREATE_APPOINTMENT_CONFLIT_ERROR = 'Cannot create appointment. There is a
 CANNOT_CREATE_APPOINTMENT_OUTSIDE_WORKING_HOURS_ERROR = 'Cannot create appointment. The doctor is not working at the provided time'
 CANNOT_CREATE_APPOINTMENT_ON_DIFFERENT_DAYS_ERROR = 'Cannot create appointment. The appointment starts and ends on different days'
 CANNOT_CREATE_APPOINTMENT_WRONG_TIME_ORDER_ERROR = 'Cannot create appointment. The appointment starts after it ends'
-CANNOT_FIND_AVAILABLE_APPOINTMENT_ERROR = 'No available appointments found within the given parameters'
\ No newline at end of file
+CANNOT_CONFIRM_APPOINTMENT_ERROR = 'Cannot create appointment. The booking could not be confirmed in time, check the appointments before retrying'
+CANNOT_CREATE_APPOINTMENT_UNAVAILABLE_ERROR = 'Cannot create appointment. The server is too busy, please retry'
+CANNOT_PROCESS_APPOINTMENT_ERROR = 'Cannot create appointment. The booking is invalid'
+CANNOT_FIND_AVAILABLE_APPOINTMENT_ERROR = 'No available appointments found within the given parameters'
+TIMEZONE_AWARE_DATETIME_ERROR = 'Invalid time. Timestamps must not have a time zone offset, they are all in the local time of the clinic'
+INVALID_TIME_WINDOW_ERROR = 'Invalid time window. The start of the window must be before its end'
+TIME_WINDOW_TOO_LARGE_ERROR = 'Invalid time window. The window cannot be longer than {max_days} days'
+DOCTOR_NOT_FOUND_ERROR = 'Doctor not found'
+SERIES_TOO_LONG_ERROR = 'Invalid series. The occurrences times the interval between them cannot be more than {max_days} days'
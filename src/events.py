@@ -0,0 +1,79 @@
+from collections import deque
+import json
+import threading
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+APPOINTMENT_CREATED = 'appointment.created'
+# Sent when a client resumes from an event that is no longer buffered, it should refetch its state instead of relying on its cache
+STREAM_RESET = 'stream.reset'
+
+
+class Event(NamedTuple):
+    id: int
+    type: str
+    doctor_id: Optional[int]
+    data: dict
+
+    def to_sse(self) -> str:
+        return f"id: {self.id}\nevent: {self.type}\ndata: {json.dumps(self.data)}\n\n"
+
+
+class EventBroker:
+    """
+    In-process fan-out of change events to Server-Sent Events subscribers.
+    The last max_events are kept in a ring buffer, so subscribers can resume from a Last-Event-ID and slow subscribers never
+    make the buffer grow: publishing is O(1) and never blocks on subscribers.
+    """
+
+    def __init__(self, max_events: int = 1000, heartbeat_seconds: float = 15):
+        self.heartbeat_seconds = heartbeat_seconds
+        self._events = deque(maxlen=max_events)
+        self._last_event_id = 0
+        self._condition = threading.Condition()
+
+    @property
+    def last_event_id(self) -> int:
+        return self._last_event_id
+
+    def publish(self, event_type: str, doctor_id: Optional[int], data: dict) -> Event:
+        with self._condition:
+            self._last_event_id += 1
+            event = Event(self._last_event_id, event_type, doctor_id, data)
+            self._events.append(event)
+            self._condition.notify_all()
+        return event
+
+    def wait_for_events(self, last_event_id: int, timeout: Optional[float] = None) -> Tuple[List[Event], bool]:
+        """ Return the events published after last_event_id, and whether some of them were already dropped from the buffer """
+        with self._condition:
+            self._condition.wait_for(lambda: self._last_event_id > last_event_id, timeout)
+            if not self._events or self._last_event_id <= last_event_id:
+                return [], False
+
+            # Event ids are consecutive, so the position of the first event to send can be computed instead of searched
+            first_buffered_id = self._events[0].id
+            missed = last_event_id < first_buffered_id - 1
+            start = max(last_event_id - first_buffered_id + 1, 0)
+            return [self._events[i] for i in range(start, len(self._events))], missed
+
+    def subscribe(self, last_event_id: Optional[int] = None, doctor_id: Optional[int] = None) -> Iterator[str]:
+        """ Yield the Server-Sent Events messages for the events after last_event_id (or only the new ones), forever """
+        current_event_id = self._last_event_id
+        if last_event_id is None:
+            last_event_id = current_event_id
+        elif last_event_id > current_event_id:
+            # The ids restart from 0 with the process, so the client's last event comes from a previous one: it can't tell what it missed
+            yield Event(current_event_id, STREAM_RESET, None, {}).to_sse()
+            last_event_id = current_event_id
+
+        while True:
+            events, missed = self.wait_for_events(last_event_id, self.heartbeat_seconds)
+            if missed:
+                yield Event(events[0].id - 1, STREAM_RESET, None, {}).to_sse()
+            if not events:
+                yield ': keep-alive\n\n'  # Comments are ignored by clients, but let proxies and servers notice dead connections
+
+            for event in events:
+                if doctor_id is None or event.doctor_id is None or event.doctor_id == doctor_id:
+                    yield event.to_sse()
+                last_event_id = event.id
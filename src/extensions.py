@@ -1,2 +1,4 @@
 from flask_sqlalchemy import SQLAlchemy
-db = SQLAlchemy()
\ No newline at end of file
+from src.events import EventBroker
+db = SQLAlchemy()
+events = EventBroker()
@@ -0,0 +1,129 @@
+from concurrent.futures import Future
+import queue
+import threading
+import time as timer
+from typing import List, NamedTuple, Optional, Tuple
+
+from flask import Flask
+
+from src.extensions import db
+from src.helpers import Booking, book_appointments, find_schedule_error, find_time_error, load_busy_intervals, load_working_hours
+from src.intervals import Interval, union
+
+
+class GroupCommitterStopped(RuntimeError):
+    """ Raised when submitting a booking while the worker isn't running, i.e. after close or if it died """
+
+
+# (appointment as a dict, None) if booked, (None, error message) otherwise
+BookingResult = Tuple[Optional[dict], Optional[str]]
+
+
+class PendingBooking(NamedTuple):
+    doctor_id: int
+    appointment: Interval
+    notes: Optional[str]
+    # Resolves to a BookingResult, or raises if the booking couldn't be processed at all
+    future: Future
+
+
+class GroupCommitter:
+    """
+    Collects concurrent bookings in short-lived batches, up to max_batch_size bookings or window_ms milliseconds after the first one.
+    Each batch is validated at once (a query for the existing appointments and one for the working hours of all its doctors) and
+    committed in a single transaction, so a busy server pays one commit (and one fsync) per batch instead of one per booking.
+    A single worker thread processes the batches, which also serializes the conflict checks with the writes.
+    """
+
+    def __init__(self, app: Flask, max_batch_size: int = 64, window_ms: float = 5):
+        self.app = app
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name='group-commit', daemon=True)
+        self._worker.start()
+
+    def submit(self, doctor_id: int, appointment_starts_at, appointment_ends_at, notes: Optional[str] = None) -> Future:
+        if not self._worker.is_alive():
+            raise GroupCommitterStopped('The group commit worker is not running')
+        future = Future()
+        self._queue.put(PendingBooking(doctor_id, (appointment_starts_at, appointment_ends_at), notes, future))
+        return future
+
+    def close(self):
+        """ Process the bookings already submitted, then stop the worker """
+        self._queue.put(None)
+        self._worker.join()
+
+    def _run(self):
+        while (first := self._queue.get()) is not None:
+            batch = [first]
+            deadline = timer.monotonic() + self.window
+            stop = False
+            while len(batch) < self.max_batch_size:
+                try:
+                    pending = self._queue.get(timeout=max(deadline - timer.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if pending is None:
+                    stop = True
+                    break
+                batch.append(pending)
+
+            # The bookings whose caller gave up waiting are skipped, the others can't be cancelled anymore
+            batch = [pending for pending in batch if pending.future.set_running_or_notify_cancel()]
+            if batch:
+                with self.app.app_context():
+                    self._process(batch)
+            if stop:
+                return
+
+    def _process(self, batch: List[PendingBooking]):
+        """
+        Book the batch together. If anything fails, i.e. a booking that can't be compared with the others or the commit itself,
+        the bookings are retried one at a time so a bad one only fails its own caller.
+        """
+        try:
+            results = self._book(batch)
+        except Exception as e:
+            db.session.rollback()
+            if len(batch) == 1:
+                batch[0].future.set_exception(e)
+            else:
+                for pending in batch:
+                    self._process([pending])
+            return
+
+        # Set only once the batch is committed: a booking rejected because of another one of the batch is wrong if the batch is rolled back
+        for pending, result in results:
+            pending.future.set_result(result)
+
+    def _book(self, batch: List[PendingBooking]) -> List[Tuple[PendingBooking, BookingResult]]:
+        results, valid = [], []
+        for pending in batch:
+            if error := find_time_error(pending.appointment):
+                results.append((pending, (None, error)))
+            else:
+                valid.append(pending)
+        if not valid:
+            return results
+
+        doctor_ids = list({pending.doctor_id for pending in valid})
+        busy = load_busy_intervals(
+            doctor_ids, min(pending.appointment[0] for pending in valid), max(pending.appointment[1] for pending in valid)
+        )
+        working_hours = load_working_hours(doctor_ids)
+
+        # In arrival order, so the first booking wins when two of the same batch conflict
+        accepted: List[Tuple[PendingBooking, Booking]] = []
+        for pending in valid:
+            if error := find_schedule_error(pending.appointment, busy[pending.doctor_id], working_hours[pending.doctor_id]):
+                results.append((pending, (None, error)))
+                continue
+            busy[pending.doctor_id] = union(busy[pending.doctor_id], [pending.appointment])
+            accepted.append((pending, (pending.doctor_id, pending.appointment, pending.notes)))
+        if not accepted:
+            return results
+
+        booked = book_appointments([booking for _, booking in accepted])
+        return results + [(pending, (appointment, None)) for (pending, _), appointment in zip(accepted, booked)]
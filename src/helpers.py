@@ -1,70 +1,144 @@
-from datetime import datetime, timedelta
+from collections import defaultdict
+from datetime import date, datetime, timedelta
 import heapq
-from operator import and_, or_
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 
+from src import errors
+from src.events import APPOINTMENT_CREATED
+from src.extensions import db, events
+from src.intervals import Interval, contains, first_gap, intersect, iter_intersect, longest, normalize, overlaps, subtract, total
 from src.models import Appointment, Doctor, WorkingHours
 
 
+# ========== Working hours ==========
+
+def working_intervals_by_day(working_hours: List[WorkingHours]) -> Dict[int, List[Interval]]:
+    """ Group the working hours by day of the week, as normalized (start_time, end_time) interval sets """
+    shifts = defaultdict(list)
+    for wh in working_hours:
+        shifts[wh.day_of_the_week].append((wh.start_time, wh.end_time))
+    return {day: normalize(day_shifts) for day, day_shifts in shifts.items()}
+
+
+def load_working_hours(doctor_ids: List[int]) -> Dict[int, Dict[int, List[Interval]]]:
+    """ Load the working hours of the doctors in a single query, by doctor id and day of the week. Doctors without working hours are included too """
+    working_hours = {doctor_id: [] for doctor_id in doctor_ids}
+    for wh in WorkingHours.query.filter(WorkingHours.doctor_id.in_(doctor_ids)):
+        working_hours[wh.doctor_id].append(wh)
+    return {doctor_id: working_intervals_by_day(doctor_working_hours) for doctor_id, doctor_working_hours in working_hours.items()}
+
+
+def working_intervals_on(working_hours: Dict[int, List[Interval]], day: date) -> List[Interval]:
+    return [(datetime.combine(day, start), datetime.combine(day, end)) for start, end in working_hours.get(day.weekday(), [])]
+
+
+def working_intervals_between(working_hours: Dict[int, List[Interval]], first_day: date, last_day: date) -> List[Interval]:
+    """ Working intervals from first_day to last_day (both included), as a single normalized interval set """
+    shifts = []
+    current_day = first_day
+    while current_day <= last_day:
+        shifts.extend(working_intervals_on(working_hours, current_day))
+        current_day += timedelta(days=1)
+    return shifts
+
+
+# ========== Booking validation ==========
+
+def find_time_error(appointment: Interval) -> Optional[str]:
+    """ Return why the appointment's times are invalid on their own, if they are """
+    appointment_starts_at, appointment_ends_at = appointment
+    # This is an assumption, but I think it's a reasonable one.
+    if appointment_starts_at.date() != appointment_ends_at.date():
+        return errors.CANNOT_CREATE_APPOINTMENT_ON_DIFFERENT_DAYS_ERROR
+
+    if appointment_starts_at >= appointment_ends_at:
+        return errors.CANNOT_CREATE_APPOINTMENT_WRONG_TIME_ORDER_ERROR
+    return None
+
+
+def find_schedule_error(appointment: Interval, busy: List[Interval], working_hours: Dict[int, List[Interval]]) -> Optional[str]:
+    """ Return why the appointment can't be booked given the doctor's existing appointments and working hours, if it can't """
+    # A conflit can happen in the following cases:
+    # - New appointment inside an existing appointment (edge case new appointment starts and ends at the same time as an existing appointment)
+    # - New appointment starts before an existing appointment and ends inside it
+    # - New appointment starts inside an existing appointment and ends after it
+    # - New appointment starts before an existing appointment and ends after it
+    if overlaps(busy, appointment):
+        return errors.CANNOT_CREATE_APPOINTMENT_CONFLIT_ERROR
+
+    # Check if we are trying to create an appointment outside of working hours.
+    # The appointment must fit entirely inside one of the doctor's shifts for that day, if the doctor is working at all.
+    if not contains(working_intervals_on(working_hours, appointment[0].date()), appointment):
+        return errors.CANNOT_CREATE_APPOINTMENT_OUTSIDE_WORKING_HOURS_ERROR
+    return None
+
+
+# (doctor id, (start time, end time), notes) of an appointment to book
+Booking = Tuple[int, Interval, Optional[str]]
+
+
+def book_appointments(bookings: List[Booking]) -> List[dict]:
+    """ Insert the already validated appointments in a single transaction and publish them to the change feed """
+    new_appointments = [
+        Appointment(start_time=appointment_starts_at, end_time=appointment_ends_at, doctor_id=doctor_id, notes=notes)
+        for doctor_id, (appointment_starts_at, appointment_ends_at), notes in bookings
+    ]
+    db.session.add_all(new_appointments)
+    db.session.flush()  # Assigns the ids, so the appointments can be serialized without reloading them once the commit expires them
+    booked = [{**new_appointment.to_dict(), 'doctor_id': new_appointment.doctor_id} for new_appointment in new_appointments]
+    db.session.commit()
+
+    for appointment in booked:
+        events.publish(APPOINTMENT_CREATED, appointment['doctor_id'], appointment)
+    return booked
+
+
+# ========== Brute force approach ==========
+
 def brute_force_approach(doctors: List[Doctor], start_time: datetime, appointment_length_minutes: int) -> Tuple[Optional[datetime], Optional[int]]:
     earliest_available = None
     earliest_available_doctor = None
 
     for doctor in doctors:
-        working_hours = {wh.day_of_the_week: wh for wh in doctor.working_hours}
+        working_hours = working_intervals_by_day(doctor.working_hours)
         available_slot = find_first_available_slot(doctor, working_hours, start_time, appointment_length_minutes)
-        
+
         if available_slot and (earliest_available is None or available_slot < earliest_available):
             earliest_available = available_slot
             earliest_available_doctor = doctor
 
     return earliest_available, earliest_available_doctor.id if earliest_available_doctor else None
-    
+
 
 def find_first_available_slot(
-    doctor: Doctor, working_hours: Dict[int, WorkingHours], start_time: datetime, appointment_length_minutes: int, max_look_ahead_in_days: int = 30
-    ):
-    max_look_ahead = timedelta(days=max_look_ahead_in_days) 
-    
-    current_day, current_time = start_time.date(), start_time.time()
-    while current_day - start_time.date() < max_look_ahead:
-        if day_of_week := current_day.weekday() not in working_hours: # Move to the next day if the current day is not a working day
-            current_day, current_time = next_working_day_start(working_hours, current_day)
-
-        wh = working_hours[day_of_week]
-        # Check if the current_time is within the working hours for the current day
-        if wh.start_time <= current_time < wh.end_time:
-            potential_start = datetime.combine(current_day, current_time)
-            potential_end = potential_start + timedelta(minutes=appointment_length_minutes)
-            
-            # Ensure the potential end time does not exceed working hours
-            if potential_end.time() > wh.end_time:
-                continue # Discard this potential slot and move to the next one
-            
-            conflitcs = Appointment.query.filter(
-                Appointment.doctor_id == doctor.id,
-                or_(
-                    and_(Appointment.start_time <= potential_start, Appointment.end_time > potential_start),
-                    and_(Appointment.start_time < potential_end, Appointment.end_time >= potential_end)
-                )
-            ).all()
-            
-            # If no conflicting appointments, this time slot is available
-            if not conflitcs:
-                return potential_start
-        
-        # Move to the next possible start time within the working day
-        current_time = (datetime.combine(current_day, current_time) + timedelta(minutes=appointment_length_minutes)).time()
-        # If current_time exceeds working hours or it's not a working day, move to the next working day
-        if current_time >= wh.end_time or day_of_week not in working_hours:
-            current_day, current_time = next_working_day_start(working_hours, current_day)
-
-
-def next_working_day_start(working_hours: Dict[int, WorkingHours], current_day: datetime):
-    current_day += timedelta(days=1)
-    while current_day.weekday() not in working_hours:
+    doctor: Doctor, working_hours: Dict[int, List[Interval]], start_time: datetime, appointment_length_minutes: int, max_look_ahead_in_days: int = 30
+    ) -> Optional[datetime]:
+    appointment_length = timedelta(minutes=appointment_length_minutes)
+
+    current_day = start_time.date()
+    while current_day - start_time.date() < timedelta(days=max_look_ahead_in_days):
+        # Only consider the portion of each shift after the requested start time
+        shifts = intersect(working_intervals_on(working_hours, current_day), [(start_time, datetime.max)])
+
+        for shift_start, shift_end in shifts:
+            potential_start = shift_start
+            # Ensure the potential end time does not exceed the shift
+            while potential_start + appointment_length <= shift_end:
+                potential_end = potential_start + appointment_length
+                conflict = Appointment.query.filter(
+                    Appointment.doctor_id == doctor.id,
+                    Appointment.start_time < potential_end,
+                    Appointment.end_time > potential_start,
+                ).first()
+
+                # If no conflicting appointments, this time slot is available
+                if not conflict:
+                    return potential_start
+                # Move to the next possible start time within the shift
+                potential_start = potential_end
+
         current_day += timedelta(days=1)
-    return current_day, working_hours[current_day.weekday()].start_time
+    return None
 
 
 # ========== Alternative approach using a heap ==========
@@ -83,44 +157,182 @@ def find_earliest_available_slot(
 
     if not potential_slots:
         return None, None
-    
+
     earliest_slot, doctor_id = heapq.heappop(potential_slots)
     return earliest_slot, doctor_id
 
 
 def generate_slots_for_doctor(
-    doctor: Doctor, start_time: datetime, appointment_length: int, max_look_ahead_in_days: int = 30, increment_by_minutes: int = 15
-):
+    doctor: Doctor, start_time: datetime, appointment_length: timedelta, max_look_ahead_in_days: int = 30, increment_by_minutes: int = 15
+) -> List[datetime]:
     slots = []
-    current_date = start_time.date()
-    look_head_limit = current_date + timedelta(days=max_look_ahead_in_days)  # Arbitrary end date for searching
+    increment = timedelta(minutes=increment_by_minutes)
+    look_head_limit = start_time.date() + timedelta(days=max_look_ahead_in_days)  # Arbitrary end date for searching
+
+    shifts = working_intervals_between(working_intervals_by_day(doctor.working_hours), start_time.date(), look_head_limit)
+    free = subtract(shifts, normalize((appointment.start_time, appointment.end_time) for appointment in doctor.appointments))
 
-    working_hours_map = {wh.day_of_the_week: wh for wh in doctor.working_hours}
-    # If start_time is after working hours, start checking from the next day
-    if start_time.weekday() in working_hours_map and start_time.time() >= working_hours_map[start_time.weekday()].end_time:
-        current_date, _ = next_working_day_start(working_hours_map, current_date)
+    # Slots are laid out every increment from the start of each shift, only the ones fully inside a free gap are kept.
+    # Both the slots and the free gaps are sorted, so a single pointer over the gaps is enough.
+    gap = 0
+    for shift_start, shift_end in shifts:
+        slot = skip_to(shift_start, start_time, increment)
+        while slot + appointment_length <= shift_end:
+            while gap < len(free) and free[gap][1] < slot + appointment_length:
+                gap += 1
+            if gap == len(free):
+                return slots
 
-    while current_date <= look_head_limit:
-        working_hours = [wh for wh in doctor.working_hours if wh.day_of_the_week == current_date.weekday()]
+            if free[gap][0] <= slot:
+                slots.append(slot)
+                slot += increment
+            else:
+                slot = skip_to(slot, free[gap][0], increment)  # Jump over the busy portion of the shift
+    return slots
 
-        for wh in working_hours:
-            current_slot_start = datetime.combine(current_date, wh.start_time)
-            working_day_end = datetime.combine(current_date, wh.end_time)
 
-            while current_slot_start + appointment_length <= working_day_end:
-                slots.append(current_slot_start)
-                current_slot_start += timedelta(minutes=increment_by_minutes)
+def skip_to(slot: datetime, not_before: datetime, increment: timedelta) -> datetime:
+    """ Move the slot forward by whole increments until it is not before not_before """
+    if slot >= not_before:
+        return slot
+    return slot - ((slot - not_before) // increment) * increment
 
-        current_date += timedelta(days=1)
 
-    # Remove slots that conflict with existing appointments
-    slots = [slot for slot in slots if slot_fits_appointment(slot, appointment_length, doctor.appointments)]
-    return slots
+# ========== Joint availability ==========
+
+def find_earliest_joint_slot(
+    doctors: List[Doctor], start_time: datetime, appointment_length_minutes: int, max_look_ahead_in_days: int = 30
+) -> Optional[datetime]:
+    """ Find the earliest start at which all the doctors are available at the same time """
+    if not doctors:
+        return None
+
+    look_head_limit = start_time.date() + timedelta(days=max_look_ahead_in_days)
+    busy = load_busy_intervals([doctor.id for doctor in doctors], start_time, datetime.combine(look_head_limit + timedelta(days=1), datetime.min.time()))
+    free_gaps = [
+        iter_free_gaps(working_intervals_by_day(doctor.working_hours), busy[doctor.id], start_time, look_head_limit)
+        for doctor in doctors
+    ]
+    return first_gap(iter_intersect(*free_gaps), timedelta(minutes=appointment_length_minutes))
+
+
+def iter_free_gaps(working_hours: Dict[int, List[Interval]], busy: List[Interval], start_time: datetime, last_day: date) -> Iterator[Interval]:
+    """ Lazily yield the free gaps of a doctor, day by day, from start_time until the end of last_day """
+    first_busy = 0
+    current_day = start_time.date()
+    while current_day <= last_day:
+        shifts = intersect(working_intervals_on(working_hours, current_day), [(start_time, datetime.max)])
+        if shifts:
+            # Only the appointments of the day are handed to subtract, so each appointment is visited once across all the days
+            while first_busy < len(busy) and busy[first_busy][1] <= shifts[0][0]:
+                first_busy += 1
+            last_busy = first_busy
+            while last_busy < len(busy) and busy[last_busy][0] < shifts[-1][1]:
+                last_busy += 1
+            yield from subtract(shifts, busy[first_busy:last_busy])
+        current_day += timedelta(days=1)
+
+
+# ========== Recurring series ==========
+
+def series_starts(start_time: datetime, occurrences: int, interval: timedelta) -> List[datetime]:
+    return [start_time + occurrence * interval for occurrence in range(occurrences)]
+
+
+def find_earliest_series_slot(
+    doctor: Doctor, start_time: datetime, appointment_length_minutes: int, occurrences: int, interval_days: int = 7, max_look_ahead_in_days: int = 30
+) -> Optional[datetime]:
+    """
+    Find the earliest start, within the look ahead, at which every occurrence of the series (one every interval_days) is free.
+    The free gaps of the whole series span are computed once, then each occurrence's gaps are shifted back by its offset and
+    intersected with the candidates: a start is valid only if it survives every intersection, so no week is searched twice.
+    """
+    interval = timedelta(days=interval_days)
+    look_ahead_limit = datetime.combine(start_time.date() + timedelta(days=max_look_ahead_in_days + 1), datetime.min.time())
+    series_end = look_ahead_limit + (occurrences - 1) * interval
+
+    shifts = working_intervals_between(working_intervals_by_day(doctor.working_hours), start_time.date(), series_end.date())
+    free = subtract(shifts, load_busy_intervals([doctor.id], start_time, series_end)[doctor.id])
+
+    candidates = intersect(free, [(start_time, look_ahead_limit)])
+    for occurrence in range(1, occurrences):
+        if not candidates:
+            return None
+        offset = occurrence * interval
+        candidates = intersect(candidates, [(start - offset, end - offset) for start, end in free])
+    return first_gap(candidates, timedelta(minutes=appointment_length_minutes))
+
+
+# ========== Availability summary ==========
+
+SUMMARY_GRANULARITIES = {
+    'day': timedelta(days=1),
+    'hour': timedelta(hours=1),
+}
+MAX_SUMMARY_WINDOW_DAYS = 92  # A quarter is more than enough to render a month view with some margin
+
+
+def load_busy_intervals(doctor_ids: List[int], start_time: datetime, end_time: datetime) -> Dict[int, List[Interval]]:
+    """ Load the appointments overlapping the time window for the given doctors in a single query, as normalized interval sets """
+    busy = {doctor_id: [] for doctor_id in doctor_ids}
+    rows = (
+        db.session.query(Appointment.doctor_id, Appointment.start_time, Appointment.end_time)
+        .filter(Appointment.doctor_id.in_(doctor_ids))
+        .filter(Appointment.start_time < end_time, Appointment.end_time > start_time)
+        .order_by(Appointment.doctor_id, Appointment.start_time)
+    )
+    for doctor_id, appointment_start, appointment_end in rows:
+        busy[doctor_id].append((appointment_start, appointment_end))
+    return {doctor_id: normalize(intervals) for doctor_id, intervals in busy.items()}
+
+
+def summarize_availability(
+    working_hours: List[WorkingHours], appointments: List[Interval], start_time: datetime, end_time: datetime, granularity: str = 'day'
+) -> List[dict]:
+    """
+    Compute the free minutes, longest free gap and booked ratio of each bucket (day or hour) between start_time and end_time.
+    The appointments must be a normalized interval set, they are visited in a single sweep alongside the buckets.
+    """
+    summary = []
+    step = SUMMARY_GRANULARITIES[granularity]
+    working_hours_by_day = working_intervals_by_day(working_hours)
+    first_appointment = 0
+
+    bucket_start = start_time
+    while bucket_start < end_time:
+        bucket_end = min(truncate_to_granularity(bucket_start, granularity) + step, end_time)
+        shifts = intersect(working_intervals_on(working_hours_by_day, bucket_start.date()), [(bucket_start, bucket_end)])
+
+        # Appointments that ended before this bucket can't overlap with this bucket nor with the next ones
+        while first_appointment < len(appointments) and appointments[first_appointment][1] <= bucket_start:
+            first_appointment += 1
+        last_appointment = first_appointment
+        while last_appointment < len(appointments) and appointments[last_appointment][0] < bucket_end:
+            last_appointment += 1
+
+        free = subtract(shifts, appointments[first_appointment:last_appointment])
+        working = total(shifts, timedelta(0))
+        booked = working - total(free, timedelta(0))
+
+        summary.append({
+            'start_time': bucket_start.isoformat(),
+            'end_time': bucket_end.isoformat(),
+            'working_minutes': to_minutes(working),
+            'free_minutes': to_minutes(working - booked),
+            'booked_minutes': to_minutes(booked),
+            'longest_free_gap_minutes': to_minutes(longest(free, timedelta(0))),
+            'booked_ratio': round(booked / working, 4) if working else 0.0,
+        })
+        bucket_start = bucket_end
+
+    return summary
+
+
+def truncate_to_granularity(moment: datetime, granularity: str) -> datetime:
+    if granularity == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return datetime.combine(moment.date(), datetime.min.time())
 
 
-def slot_fits_appointment(slot_start: datetime, appointment_length: timedelta, appointments: List[Appointment]):
-    slot_end = slot_start + appointment_length
-    for appointment in appointments:
-        if not (slot_end <= appointment.start_time or slot_start >= appointment.end_time):
-            return False
-    return True
+def to_minutes(duration: timedelta) -> int:
+    return int(duration.total_seconds() // 60)
@@ -0,0 +1,225 @@
+from collections import defaultdict
+import csv
+from datetime import datetime, time
+from itertools import islice
+import json
+from typing import Dict, IO, Iterator, List, Optional, Tuple
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, Table, and_, select
+
+from src import errors
+from src.extensions import db
+from src.helpers import find_time_error, load_working_hours
+from src.intervals import Interval, contains, normalize
+from src.models import Appointment, Doctor, WorkingHours
+
+INVALID_ROW_ERROR = 'Invalid row. {reason}'
+# Filled with the time windows of a chunk's rows, to find the existing appointments overlapping them with a join
+candidate_windows = Table(
+    'import_candidate_window', MetaData(),
+    Column('doctor_id', Integer, nullable=False),
+    Column('day_start', DateTime, nullable=False),
+    Column('start_time', DateTime, nullable=False),
+    Column('end_time', DateTime, nullable=False),
+    prefixes=['TEMPORARY'],
+)
+
+# (line number, raw record) as read from the input file
+Record = Tuple[int, dict]
+# (line number, raw record, error message)
+Reject = Tuple[int, dict, str]
+
+
+class InvalidRecord(dict):
+    """ A line that couldn't be decoded, kept as a record with the raw line so it's rejected along with the rest of its chunk """
+
+    def __init__(self, line: str, error: str):
+        super().__init__(line=line)
+        self.error = error
+
+
+def read_records(input_file: IO, input_format: str) -> Iterator[Record]:
+    """ Stream the records of a CSV (with a header) or NDJSON file, without loading the whole file in memory """
+    if input_format == 'csv':
+        reader = csv.DictReader(input_file)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for line_number, line in enumerate(input_file, start=1):
+            if line.strip():
+                try:
+                    yield line_number, json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield line_number, InvalidRecord(line.rstrip('\n'), INVALID_ROW_ERROR.format(reason=f'{type(e).__name__}: {e}'))
+
+
+def chunked(records: Iterator[Record], chunk_size: int) -> Iterator[List[Record]]:
+    while chunk := list(islice(records, chunk_size)):
+        yield chunk
+
+
+# ========== Appointments ==========
+
+def parse_appointment(record: dict, working_hours: Dict[int, Dict[int, List[Interval]]]) -> Tuple[Optional[dict], Optional[str]]:
+    """ Parse and validate a record on its own, return either the appointment row to insert or an error message """
+    if isinstance(record, InvalidRecord):
+        return None, record.error
+    try:
+        doctor_id = int(record['doctor_id'])
+        start_time = datetime.fromisoformat(record['start_time'])
+        end_time = datetime.fromisoformat(record['end_time'])
+    except (KeyError, TypeError, ValueError) as e:
+        return None, INVALID_ROW_ERROR.format(reason=f'{type(e).__name__}: {e}')
+
+    if start_time.tzinfo or end_time.tzinfo:
+        # They couldn't be compared with the naive ones of the other rows and of the database
+        return None, INVALID_ROW_ERROR.format(reason='times must not have a time zone offset')
+    if doctor_id not in working_hours:
+        return None, errors.DOCTOR_NOT_FOUND_ERROR
+    if error := find_time_error((start_time, end_time)):
+        return None, error
+    # Both ends are on the same day, so comparing the times with the shifts of that day of the week is enough
+    if not contains(working_hours[doctor_id].get(start_time.weekday(), []), (start_time.time(), end_time.time())):
+        return None, errors.CANNOT_CREATE_APPOINTMENT_OUTSIDE_WORKING_HOURS_ERROR
+
+    return {'doctor_id': doctor_id, 'start_time': start_time, 'end_time': end_time, 'notes': record.get('notes') or None}, None
+
+
+def load_overlapping_appointments(candidates: Dict[int, List[Interval]]) -> Dict[int, List[Interval]]:
+    """
+    Load the existing appointments overlapping the candidate intervals, by doctor id, as normalized interval sets.
+    The candidates are written to a temporary table and joined with the appointments, so only the rows around them are loaded:
+    the cost and the memory depend on the chunk, not on the size of the database nor on the order of the input.
+    """
+    connection = db.session.connection()
+    candidate_windows.create(connection)
+    try:
+        connection.execute(candidate_windows.insert(), [
+            # Appointments never span several days, so the ones overlapping a window start on its day: this bounds the index scan
+            {'doctor_id': doctor_id, 'day_start': datetime.combine(start.date(), time.min), 'start_time': start, 'end_time': end}
+            for doctor_id, intervals in candidates.items() for start, end in normalize(intervals)
+        ])
+        rows = connection.execute(
+            # An appointment overlapping several windows is returned once per window, normalize merges the duplicates
+            select(Appointment.doctor_id, Appointment.start_time, Appointment.end_time)
+            .select_from(candidate_windows)
+            .join(Appointment, and_(
+                Appointment.doctor_id == candidate_windows.c.doctor_id,
+                Appointment.start_time >= candidate_windows.c.day_start,
+                Appointment.start_time < candidate_windows.c.end_time,
+                Appointment.end_time > candidate_windows.c.start_time,
+            ))
+        ).all()
+    finally:
+        candidate_windows.drop(connection)
+
+    busy = {doctor_id: [] for doctor_id in candidates}
+    for doctor_id, appointment_start, appointment_end in rows:
+        busy[doctor_id].append((appointment_start, appointment_end))
+    return {doctor_id: normalize(intervals) for doctor_id, intervals in busy.items()}
+
+
+def validate_appointments_chunk(records: List[Record], working_hours: Dict[int, Dict[int, List[Interval]]]) -> Tuple[List[dict], List[Reject]]:
+    """
+    Validate a chunk of appointment records against the working hours, the existing appointments and each other.
+    Only the existing appointments overlapping the chunk's rows are loaded, then both are visited in a sorted sweep.
+    """
+    candidates, rejects = [], []
+    for line_number, record in records:
+        row, error = parse_appointment(record, working_hours)
+        if error:
+            rejects.append((line_number, record, error))
+        else:
+            candidates.append((line_number, record, row))
+    if not candidates:
+        return [], rejects
+
+    candidates.sort(key=lambda candidate: (candidate[2]['doctor_id'], candidate[2]['start_time']))
+    candidate_intervals = defaultdict(list)
+    for _, _, row in candidates:
+        candidate_intervals[row['doctor_id']].append((row['start_time'], row['end_time']))
+    busy = load_overlapping_appointments(candidate_intervals)
+
+    accepted = []
+    current_doctor_id = None
+    for line_number, record, row in candidates:
+        if row['doctor_id'] != current_doctor_id:
+            current_doctor_id, existing, next_existing, last_end = row['doctor_id'], busy[row['doctor_id']], 0, None
+
+        # Existing appointments that ended before this one can't conflict with it nor with the next ones
+        while next_existing < len(existing) and existing[next_existing][1] <= row['start_time']:
+            next_existing += 1
+        conflicts_with_existing = next_existing < len(existing) and existing[next_existing][0] < row['end_time']
+        conflicts_with_chunk = last_end is not None and last_end > row['start_time']
+
+        if conflicts_with_existing or conflicts_with_chunk:
+            rejects.append((line_number, record, errors.CANNOT_CREATE_APPOINTMENT_CONFLIT_ERROR))
+        else:
+            accepted.append(row)
+            last_end = row['end_time']
+    return accepted, rejects
+
+
+def import_appointments(records: Iterator[Record], chunk_size: int = 10000) -> Iterator[Tuple[int, List[Reject]]]:
+    """
+    Import the appointment records chunk by chunk, each chunk is validated, bulk inserted and committed in one transaction.
+    Yields the number of imported appointments and the rejected records of each chunk.
+    """
+    working_hours = load_working_hours([doctor_id for doctor_id, in db.session.query(Doctor.id)])
+    for chunk in chunked(records, chunk_size):
+        accepted, rejects = validate_appointments_chunk(chunk, working_hours)
+        if accepted:
+            db.session.execute(Appointment.__table__.insert(), accepted)  # A single executemany instead of one INSERT per ORM object
+        db.session.commit()
+        yield len(accepted), rejects
+
+
+# ========== Working hours ==========
+
+def validate_working_hours_chunk(records: List[Record], existing: Dict[int, set]) -> Tuple[List[dict], List[Reject]]:
+    """ Validate a chunk of working hours records, existing maps each doctor id to the (day, start time) of its shifts """
+    accepted, rejects = [], []
+    for line_number, record in records:
+        if isinstance(record, InvalidRecord):
+            rejects.append((line_number, record, record.error))
+            continue
+        try:
+            doctor_id = int(record['doctor_id'])
+            day_of_the_week = int(record['day_of_the_week'])
+            start_time = time.fromisoformat(record['start_time'])
+            end_time = time.fromisoformat(record['end_time'])
+        except (KeyError, TypeError, ValueError) as e:
+            rejects.append((line_number, record, INVALID_ROW_ERROR.format(reason=f'{type(e).__name__}: {e}')))
+            continue
+
+        if doctor_id not in existing:
+            error = errors.DOCTOR_NOT_FOUND_ERROR
+        elif not 0 <= day_of_the_week <= 6:
+            error = INVALID_ROW_ERROR.format(reason='day_of_the_week must be between 0 (Monday) and 6 (Sunday)')
+        elif start_time >= end_time:
+            error = INVALID_ROW_ERROR.format(reason='start_time must be before end_time')
+        elif (day_of_the_week, start_time) in existing[doctor_id]:
+            error = INVALID_ROW_ERROR.format(reason='the doctor already has a shift starting at that time')
+        else:
+            error = None
+
+        if error:
+            rejects.append((line_number, record, error))
+        else:
+            existing[doctor_id].add((day_of_the_week, start_time))
+            accepted.append({'doctor_id': doctor_id, 'day_of_the_week': day_of_the_week, 'start_time': start_time, 'end_time': end_time})
+    return accepted, rejects
+
+
+def import_working_hours(records: Iterator[Record], chunk_size: int = 10000) -> Iterator[Tuple[int, List[Reject]]]:
+    """ Same as import_appointments, for working hours """
+    existing = {doctor_id: set() for doctor_id, in db.session.query(Doctor.id)}
+    for doctor_id, day_of_the_week, start_time in db.session.query(WorkingHours.doctor_id, WorkingHours.day_of_the_week, WorkingHours.start_time):
+        existing[doctor_id].add((day_of_the_week, start_time))
+
+    for chunk in chunked(records, chunk_size):
+        accepted, rejects = validate_working_hours_chunk(chunk, existing)
+        if accepted:
+            db.session.execute(WorkingHours.__table__.insert(), accepted)
+        db.session.commit()
+        yield len(accepted), rejects
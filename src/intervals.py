@@ -0,0 +1,136 @@
+from bisect import bisect_right
+from itertools import islice
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+# An interval is a (start, end) tuple, closed on the start and open on the end: [start, end).
+# The bounds can be anything comparable (datetimes, times, numbers). All the functions below, except normalize,
+# expect normalized interval sets: sorted by start, without empty, overlapping or adjacent intervals.
+# This lets every operation run in a single linear merge, or a binary search for point lookups.
+Interval = Tuple[Any, Any]
+
+
+def normalize(intervals: Iterable[Interval]) -> List[Interval]:
+    """ Sort the intervals, drop the empty ones and coalesce the overlapping or adjacent ones """
+    normalized = []
+    for start, end in sorted(intervals):
+        if start >= end:
+            continue
+        if normalized and start <= normalized[-1][1]:
+            if end > normalized[-1][1]:
+                normalized[-1] = (normalized[-1][0], end)
+        else:
+            normalized.append((start, end))
+    return normalized
+
+
+def union(a: List[Interval], b: List[Interval]) -> List[Interval]:
+    result = []
+    i = j = 0
+    while i < len(a) or j < len(b):
+        if j >= len(b) or (i < len(a) and a[i][0] <= b[j][0]):
+            start, end = a[i]
+            i += 1
+        else:
+            start, end = b[j]
+            j += 1
+        if result and start <= result[-1][1]:
+            if end > result[-1][1]:
+                result[-1] = (result[-1][0], end)
+        else:
+            result.append((start, end))
+    return result
+
+
+def intersect(a: List[Interval], b: List[Interval]) -> List[Interval]:
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start = max(a[i][0], b[j][0])
+        end = min(a[i][1], b[j][1])
+        if start < end:
+            result.append((start, end))
+        # Advance the interval that ends first, it can't overlap with anything else in the other set
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def subtract(a: List[Interval], b: List[Interval]) -> List[Interval]:
+    """ Remove from a every portion covered by b """
+    result = []
+    j = 0
+    for start, end in a:
+        # Skip the intervals of b that end before this interval starts, they can't affect the next ones either
+        while j < len(b) and b[j][1] <= start:
+            j += 1
+        k = j
+        while k < len(b) and b[k][0] < end:
+            if b[k][0] > start:
+                result.append((start, b[k][0]))
+            start = max(start, b[k][1])
+            k += 1
+        if start < end:
+            result.append((start, end))
+    return result
+
+
+def iter_intersect(*streams: Iterable[Interval]) -> Iterator[Interval]:
+    """
+    Lazily intersect normalized interval streams, i.e. generators. Only the streams whose current interval ends first are
+    advanced, so the cost depends on the number of intervals inspected before the caller stops, not on the length of the streams.
+    """
+    iterators = [iter(stream) for stream in streams]
+    current = [next(iterator, None) for iterator in iterators]
+    while current and None not in current:
+        start = max(interval[0] for interval in current)
+        end = min(interval[1] for interval in current)
+        if start < end:
+            yield start, end
+        # The intervals ending first can't overlap with anything after them in the other streams
+        for i, interval in enumerate(current):
+            if interval[1] == end:
+                current[i] = next(iterators[i], None)
+
+
+def first_gap(intervals: Iterable[Interval], length: Any, not_before: Optional[Any] = None) -> Optional[Any]:
+    """
+    Return the earliest start, not before not_before, of a window of the given length that fits in the intervals.
+    The intervals can be a lazy stream when not_before isn't given, it's consumed only up to the first gap long enough.
+    """
+    index = 0 if not_before is None else find(intervals, not_before)
+    for start, end in islice(intervals, index, None):
+        if not_before is not None and start < not_before:
+            start = not_before
+        if start + length <= end:
+            return start
+    return None
+
+
+def find(intervals: List[Interval], point: Any) -> int:
+    """ Return the index of the first interval that ends after the point """
+    index = bisect_right(intervals, (point,)) - 1  # Last interval starting before the point, if any
+    if index < 0 or intervals[index][1] <= point:
+        index += 1
+    return index
+
+
+def contains(intervals: List[Interval], interval: Interval) -> bool:
+    """ Whether the interval is fully covered by a single interval of the set """
+    index = find(intervals, interval[0])
+    return index < len(intervals) and intervals[index][0] <= interval[0] and interval[1] <= intervals[index][1]
+
+
+def overlaps(intervals: List[Interval], interval: Interval) -> bool:
+    """ Whether the interval shares any portion with the set """
+    index = find(intervals, interval[0])
+    return index < len(intervals) and intervals[index][0] < interval[1]
+
+
+def total(intervals: List[Interval], zero: Any = 0) -> Any:
+    return sum((end - start for start, end in intervals), zero)
+
+
+def longest(intervals: List[Interval], zero: Any = 0) -> Any:
+    return max((end - start for start, end in intervals), default=zero)
@@ -1,7 +1,7 @@
 import calendar
 
 from src.extensions import db
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import CheckConstraint, UniqueConstraint
 
 
 class Doctor(db.Model):
@@ -26,7 +26,11 @@ class WorkingHours(db.Model):
     end_time = db.Column(db.Time, nullable=False)
     doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
 
-    __table_args__ = (UniqueConstraint('doctor_id', 'day_of_the_week', name='unique_doctor_working_hour_per_day'),)
+    # A doctor can have several shifts on the same day (i.e. a lunch break or a split schedule), overlapping shifts are merged when read
+    __table_args__ = (
+        UniqueConstraint('doctor_id', 'day_of_the_week', 'start_time', name='unique_doctor_working_hour_start_per_day'),
+        CheckConstraint('start_time < end_time', name='working_hour_starts_before_it_ends'),
+    )
 
     def __repr__(self):
         return f"WorkingHours('{self.day_of_the_week}', '{self.start_time}', '{self.end_time}')"
@@ -42,6 +46,8 @@ class WorkingHours(db.Model):
 
 class Appointment(db.Model):
     MAX_APPOINMENT_LENGTH = 60 * 2 # 2 hours 
+    MAX_SERIES_OCCURRENCES = 52 # A year of weekly appointments
+    MAX_SERIES_SPAN_DAYS = 366 # occurrences * interval_days, so a series never searches or books more than a year ahead
 
     id = db.Column(db.Integer, primary_key=True)
     start_time = db.Column(db.DateTime, nullable=False, index=True)  # Indexing these columns will speed up queries to find conflict when using the brute force approach
@@ -50,6 +56,11 @@ class Appointment(db.Model):
 
     notes = db.Column(db.Text, nullable=True)
 
+    # Finding the appointments of a doctor around a time (i.e. the conflicts of a booking) is a range scan on this index
+    __table_args__ = (
+        db.Index('ix_appointment_doctor_id_start_time', 'doctor_id', 'start_time'),
+    )
+
     def __repr__(self):
         return f"Appointment('{self.start_time}', '{self.end_time}')"
 
@@ -1,5 +1,9 @@
+from contextlib import contextmanager
 from datetime import time, datetime, timedelta
+import time as timer
+from flask import request_finished, request_started
 import pytest
+from sqlalchemy import event
 
 from src.app import create_app
 
@@ -25,6 +29,58 @@ def db(app):
         db.drop_all()
 
 
+@pytest.fixture
+def query_budget(app, db):
+    """
+    Context manager recording every SQL statement executed by the requests made inside it, failing the test if there are
+    more than max_queries statements or if they take more than max_time_ms in total. Yields the list of (statement, seconds) tuples.
+    The session is expired on entry, so the endpoints can't benefit from the objects already loaded by the fixtures.
+
+        with query_budget(max_queries=2):
+            client.get(...)
+    """
+    @contextmanager
+    def assert_query_budget(max_queries, max_time_ms=None):
+        statements = []
+        recording = False
+
+        def start_recording(sender, **extra):
+            nonlocal recording
+            recording = True
+
+        def stop_recording(sender, **extra):
+            nonlocal recording
+            recording = False
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            context._query_started_at = timer.perf_counter()
+
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if recording:  # Ignore the queries made by the test itself, i.e. to refresh the fixtures
+                statements.append((statement, timer.perf_counter() - context._query_started_at))
+
+        db.session.expire_all()
+        request_started.connect(start_recording, app)
+        request_finished.connect(stop_recording, app)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute', after_cursor_execute)
+        try:
+            yield statements
+        finally:
+            request_started.disconnect(start_recording, app)
+            request_finished.disconnect(stop_recording, app)
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+            event.remove(db.engine, 'after_cursor_execute', after_cursor_execute)
+
+        executed = '\n'.join(f'  {statement}' for statement, _ in statements)
+        assert len(statements) <= max_queries, f'Executed {len(statements)} queries, the budget is {max_queries}:\n{executed}'
+        if max_time_ms is not None:
+            total_ms = sum(seconds for _, seconds in statements) * 1000
+            assert total_ms <= max_time_ms, f'Queries took {total_ms:.1f}ms, the budget is {max_time_ms}ms:\n{executed}'
+
+    return assert_query_budget
+
+
 @pytest.fixture
 def doctor_strange(db):
     from src.models import Doctor
@@ -50,6 +106,24 @@ def dr_strange_working_hours(db, doctor_strange):
     return working_hours
 
 
+@pytest.fixture
+def dr_strange_split_working_hours(db, doctor_strange):
+    """Dr Strange works from 9:00 to 12:00 and from 13:00 to 17:00, Monday to Friday"""
+    from src.models import WorkingHours
+    working_hours = []
+    for day in range(5): # 0 is Monday, 4 is Friday
+        for start, end in ((9, 12), (13, 17)):
+            working_hours.append(WorkingHours(
+                day_of_the_week=day,
+                start_time=time(hour=start),
+                end_time=time(hour=end),
+                doctor_id=doctor_strange.id
+            ))
+    db.session.add_all(working_hours)
+    db.session.commit()
+    return working_hours
+
+
 @pytest.fixture
 def dr_strange_appointment(db, doctor_strange):
     from src.models import Appointment
@@ -131,4 +205,16 @@ def dr_who_appointment(db, doctor_who):
     )
     db.session.add(appointment)
     db.session.commit()
-    return appointment
\ No newline at end of file
+    return appointment
+
+@pytest.fixture
+def group_commit_app(tmp_path):
+    """App booking through the group commit pipeline, with Dr Strange (id 1) and Dr Who (id 2). A file database lets the worker
+    thread and the requests use their own connections"""
+    app = create_app(config={
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "db.sqlite"}',
+        'GROUP_COMMIT_ENABLED': True,
+        'GROUP_COMMIT_WINDOW_MS': 200,
+    })
+    yield app
+    app.extensions['group_commit'].close()
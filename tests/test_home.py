@@ -1,18 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from http import HTTPStatus
+import json
+import pytest
 
-from src.errors import CANNOT_CREATE_APPOINTMENT_CONFLIT_ERROR, CANNOT_CREATE_APPOINTMENT_ON_DIFFERENT_DAYS_ERROR, CANNOT_CREATE_APPOINTMENT_OUTSIDE_WORKING_HOURS_ERROR, CANNOT_CREATE_APPOINTMENT_WRONG_TIME_ORDER_ERROR
+from src.errors import CANNOT_CREATE_APPOINTMENT_CONFLIT_ERROR, CANNOT_CREATE_APPOINTMENT_ON_DIFFERENT_DAYS_ERROR, CANNOT_CREATE_APPOINTMENT_OUTSIDE_WORKING_HOURS_ERROR, CANNOT_CREATE_APPOINTMENT_WRONG_TIME_ORDER_ERROR, DOCTOR_NOT_FOUND_ERROR, INVALID_TIME_WINDOW_ERROR, SERIES_TOO_LONG_ERROR, TIMEZONE_AWARE_DATETIME_ERROR
+
+# SQL query budgets per endpoint call, they must not grow with the number of doctors or appointments
+GET_APPOINTMENTS_QUERY_BUDGET = 2
+CREATE_APPOINTMENT_QUERY_BUDGET = 4
+FIRST_AVAILABLE_QUERY_BUDGET = 3
+JOINT_APPOINTMENT_QUERY_BUDGET = 3  # Plus an INSERT per doctor
+QUERY_TIME_BUDGET_MS = 100
 
 
 # Test get_appointments endpoint, when there are no appointments
-def test_get_appointments_no_appointments(client, doctor_strange, dr_strange_working_hours):
-    response = client.get(f'/doctors/{doctor_strange.id}/appointments?start_time=2020-01-01T00:00:00&end_time=2020-01-01T23:59:59')
+def test_get_appointments_no_appointments(client, query_budget, doctor_strange, dr_strange_working_hours):
+    with query_budget(max_queries=GET_APPOINTMENTS_QUERY_BUDGET, max_time_ms=QUERY_TIME_BUDGET_MS):
+        response = client.get(f'/doctors/{doctor_strange.id}/appointments?start_time=2020-01-01T00:00:00&end_time=2020-01-01T23:59:59')
     assert response.status_code == HTTPStatus.OK
     assert response.json == []
 
 
 # Test get_appointments endpoint, when there are appointments
-def test_get_appointments_with_appointments(client, doctor_strange, dr_strange_working_hours, dr_strange_appointment):
-    response = client.get(f'/doctors/{doctor_strange.id}/appointments?start_time=2024-01-01T00:00:00&end_time=2024-01-01T23:59:59')
+def test_get_appointments_with_appointments(client, query_budget, doctor_strange, dr_strange_working_hours, dr_strange_appointment):
+    with query_budget(max_queries=GET_APPOINTMENTS_QUERY_BUDGET, max_time_ms=QUERY_TIME_BUDGET_MS):
+        response = client.get(f'/doctors/{doctor_strange.id}/appointments?start_time=2024-01-01T00:00:00&end_time=2024-01-01T23:59:59')
     assert response.status_code == HTTPStatus.OK
     assert len(response.json) == 1
     assert response.json[0].get('start_time') == '2024-01-01T09:00:00'
@@ -79,24 +92,26 @@ def test_get_appointments_with_appointments_before_the_window(client, doctor_str
 
 
 # Test create_appointment endpoint when there is no conflict
-def test_create_appointment_no_conflict(client, doctor_strange, dr_strange_working_hours, dr_strange_appointment):
-    response = client.post(f'/doctors/{doctor_strange.id}/appointments', json={
-        'appointment_starts_at': '2024-01-01T10:30:00', 
-        'appointment_ends_at': '2024-01-01T11:00:00',
-        'notes': 'test notes'
-    })
+def test_create_appointment_no_conflict(client, query_budget, doctor_strange, dr_strange_working_hours, dr_strange_appointment):
+    with query_budget(max_queries=CREATE_APPOINTMENT_QUERY_BUDGET, max_time_ms=QUERY_TIME_BUDGET_MS):
+        response = client.post(f'/doctors/{doctor_strange.id}/appointments', json={
+            'appointment_starts_at': '2024-01-01T10:30:00', 
+            'appointment_ends_at': '2024-01-01T11:00:00',
+            'notes': 'test notes'
+        })
     assert response.status_code == HTTPStatus.CREATED
     assert response.json.get('start_time') == '2024-01-01T10:30:00'
     assert response.json.get('end_time') == '2024-01-01T11:00:00'
 
 
 # Test create_appointment endpoint when there is a conflict, but the new appointment starts and ends at the same time as an existing appointment
-def test_create_appointment_conflict_same_time(client, doctor_strange, dr_strange_working_hours, dr_strange_appointment):
-    response = client.post(f'/doctors/{doctor_strange.id}/appointments', json={
-        'appointment_starts_at': '2024-01-01T09:00:00', 
-        'appointment_ends_at': '2024-01-01T10:00:00',
-        'notes': 'test notes'
-    })
+def test_create_appointment_conflict_same_time(client, query_budget, doctor_strange, dr_strange_working_hours, dr_strange_appointment):
+    with query_budget(max_queries=CREATE_APPOINTMENT_QUERY_BUDGET, max_time_ms=QUERY_TIME_BUDGET_MS):
+        response = client.post(f'/doctors/{doctor_strange.id}/appointments', json={
+            'appointment_starts_at': '2024-01-01T09:00:00', 
+            'appointment_ends_at': '2024-01-01T10:00:00',
+            'notes': 'test notes'
+        })
     assert response.status_code == HTTPStatus.CONFLICT
     assert response.json == {'error': CANNOT_CREATE_APPOINTMENT_CONFLIT_ERROR}
 
@@ -123,12 +138,13 @@ def test_create_appointment_conflict_inside_and_after(client, doctor_strange, dr
 
 
 # Test create_appointment endpoint with new appoiment fully outside of working hours (before)
-def test_create_appointment_outside_working_hours(client, doctor_strange, dr_strange_working_hours):
-    response = client.post(f'/doctors/{doctor_strange.id}/appointments', json={
-        'appointment_starts_at': '2024-01-01T07:30:00', 
-        'appointment_ends_at': '2024-01-01T08:30:00',
-        'notes': 'test notes'
-    })
+def test_create_appointment_outside_working_hours(client, query_budget, doctor_strange, dr_strange_working_hours):
+    with query_budget(max_queries=CREATE_APPOINTMENT_QUERY_BUDGET, max_time_ms=QUERY_TIME_BUDGET_MS):
+        response = client.post(f'/doctors/{doctor_strange.id}/appointments', json={
+            'appointment_starts_at': '2024-01-01T07:30:00', 
+            'appointment_ends_at': '2024-01-01T08:30:00',
+            'notes': 'test notes'
+        })
     assert response.status_code == HTTPStatus.BAD_REQUEST
     assert response.json == {'error': CANNOT_CREATE_APPOINTMENT_OUTSIDE_WORKING_HOURS_ERROR}
 
@@ -260,8 +276,9 @@ def test_create_appointment_and_get_appointments(client, doctor_strange, dr_stra
 
 
 # Test find first available appointment
-def test_find_first_available_appointment(client, doctor_strange, dr_strange_working_hours, dr_strange_appointment):
-    response = client.get(f'/appointments/first_available?start_time=2024-01-01T00:00:00')
+def test_find_first_available_appointment(client, query_budget, doctor_strange, dr_strange_working_hours, dr_strange_appointment):
+    with query_budget(max_queries=FIRST_AVAILABLE_QUERY_BUDGET, max_time_ms=QUERY_TIME_BUDGET_MS):
+        response = client.get(f'/appointments/first_available?start_time=2024-01-01T00:00:00')
     assert response.status_code == HTTPStatus.OK
     assert response.json.get('start_time') == '2024-01-01T10:00:00' # Because the doctor start working at 9:00 but has an appointment until 10:00
     assert response.json.get('end_time') == '2024-01-01T10:30:00'
@@ -276,9 +293,10 @@ def test_find_first_available_appointment_no_doctors(client):
 
 # Test find first available appointment when there are two doctors
 def test_find_first_available_appointment_two_doctors(
-    client, doctor_strange, doctor_who, dr_strange_working_hours, dr_who_working_hours, dr_strange_appointment, dr_who_appointment
+    client, query_budget, doctor_strange, doctor_who, dr_strange_working_hours, dr_who_working_hours, dr_strange_appointment, dr_who_appointment
 ):
-    response = client.get(f'/appointments/first_available?start_time=2024-01-01T00:00:00')
+    with query_budget(max_queries=FIRST_AVAILABLE_QUERY_BUDGET, max_time_ms=QUERY_TIME_BUDGET_MS):
+        response = client.get(f'/appointments/first_available?start_time=2024-01-01T00:00:00')
     assert response.status_code == HTTPStatus.OK
     assert response.json.get('start_time') == '2024-01-01T08:00:00' # Because the doctor who working at 8:00 and has no appointments at that time
     assert response.json.get('end_time') == '2024-01-01T08:30:00'
@@ -304,14 +322,16 @@ def test_find_first_available_appointment_starting_at_6(client, doctor_who, dr_w
 
 
 # Test find first available appointment with a doctor full schedule
-def test_find_first_available_appointment_full_schedule(client, doctor_strange, dr_strange_working_hours, dr_strange_month_full_of_appointments):
-    response = client.get(f'/appointments/first_available?start_time=2024-01-01T00:00:00')
+def test_find_first_available_appointment_full_schedule(client, query_budget, doctor_strange, dr_strange_working_hours, dr_strange_month_full_of_appointments):
+    with query_budget(max_queries=FIRST_AVAILABLE_QUERY_BUDGET, max_time_ms=QUERY_TIME_BUDGET_MS):
+        response = client.get(f'/appointments/first_available?start_time=2024-01-01T00:00:00')
     assert response.status_code == HTTPStatus.NOT_FOUND  # Because the doctor has a full schedule for the next 30 days
 
 
 # Test find first available appointment with a doctor full schedule, but only for 10 days
-def test_find_first_available_appointment_10_days_schedule(client, doctor_strange, dr_strange_working_hours, dr_strange_10_days_appointments):
-    response = client.get(f'/appointments/first_available?start_time=2024-01-01T00:00:00')
+def test_find_first_available_appointment_10_days_schedule(client, query_budget, doctor_strange, dr_strange_working_hours, dr_strange_10_days_appointments):
+    with query_budget(max_queries=FIRST_AVAILABLE_QUERY_BUDGET, max_time_ms=QUERY_TIME_BUDGET_MS):
+        response = client.get(f'/appointments/first_available?start_time=2024-01-01T00:00:00')
     assert response.status_code == HTTPStatus.OK
     assert response.json.get('start_time') == '2024-01-11T09:00:00' # Because the doctor has a full schedule for the next 10 days
     assert response.json.get('end_time') == '2024-01-11T09:30:00'
@@ -332,4 +352,504 @@ def test_find_first_available_appointment_custom_length(client, doctor_strange,
     assert response.status_code == HTTPStatus.OK
     assert response.json.get('start_time') == '2024-01-01T10:00:00' # Because the doctor start working at 9:00 but has an appointment until 10:00
     assert response.json.get('end_time') == '2024-01-01T11:00:00'
-    assert response.json.get('doctor_id') == doctor_strange.id
\ No newline at end of file
+    assert response.json.get('doctor_id') == doctor_strange.id
+
+# Test availability summary per day, 2024-01-01 is a Monday with one appointment from 9:00 to 10:00
+def test_availability_summary_per_day(client, doctor_strange, dr_strange_working_hours, dr_strange_appointment):
+    response = client.get(f'/doctors/{doctor_strange.id}/availability_summary?from=2024-01-01T00:00:00&to=2024-01-08T00:00:00')
+    assert response.status_code == HTTPStatus.OK
+    assert response.json.get('doctor_id') == doctor_strange.id
+    summary = response.json.get('summary')
+    assert len(summary) == 7
+    assert summary[0] == {
+        'start_time': '2024-01-01T00:00:00',
+        'end_time': '2024-01-02T00:00:00',
+        'working_minutes': 480,
+        'free_minutes': 420,
+        'booked_minutes': 60,
+        'longest_free_gap_minutes': 420,
+        'booked_ratio': 0.125,
+    }
+    assert summary[1].get('free_minutes') == 480
+    assert summary[5].get('working_minutes') == 0  # Saturday
+    assert summary[5].get('booked_ratio') == 0.0
+
+
+# Test availability summary per hour, buckets are clipped to the requested window
+def test_availability_summary_per_hour(client, doctor_strange, dr_strange_working_hours, dr_strange_appointment):
+    response = client.get(f'/doctors/{doctor_strange.id}/availability_summary?from=2024-01-01T09:30:00&to=2024-01-01T11:00:00&granularity=hour')
+    assert response.status_code == HTTPStatus.OK
+    summary = response.json.get('summary')
+    assert [bucket.get('start_time') for bucket in summary] == ['2024-01-01T09:30:00', '2024-01-01T10:00:00']
+    assert summary[0].get('free_minutes') == 0
+    assert summary[0].get('booked_ratio') == 1.0
+    assert summary[1].get('free_minutes') == 60
+
+
+# Test availability summary with a full month of appointments
+def test_availability_summary_full_schedule(client, doctor_strange, dr_strange_working_hours, dr_strange_month_full_of_appointments):
+    response = client.get(f'/doctors/{doctor_strange.id}/availability_summary?from=2024-01-01T00:00:00&to=2024-02-01T00:00:00')
+    assert response.status_code == HTTPStatus.OK
+    summary = response.json.get('summary')
+    assert len(summary) == 31
+    assert all(bucket.get('free_minutes') == 0 for bucket in summary)
+    assert all(bucket.get('booked_ratio') == 1.0 for bucket in summary if bucket.get('working_minutes'))
+
+
+# Test availability summary with an invalid time window
+def test_availability_summary_invalid_window(client, doctor_strange, dr_strange_working_hours):
+    response = client.get(f'/doctors/{doctor_strange.id}/availability_summary?from=2024-01-02T00:00:00&to=2024-01-01T00:00:00')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert response.json == {'error': INVALID_TIME_WINDOW_ERROR}
+
+    response = client.get(f'/doctors/{doctor_strange.id}/availability_summary?from=2024-01-01T00:00:00&to=2025-01-01T00:00:00')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+# Test availability summary for several doctors at once
+def test_availability_summary_multiple_doctors(
+    client, doctor_strange, doctor_who, dr_strange_working_hours, dr_who_working_hours, dr_strange_appointment
+):
+    response = client.get(
+        f'/doctors/availability_summary?doctor_ids={doctor_strange.id}&doctor_ids={doctor_who.id}&from=2024-01-01T00:00:00&to=2024-01-02T00:00:00'
+    )
+    assert response.status_code == HTTPStatus.OK
+    assert [summary.get('doctor_id') for summary in response.json] == [doctor_strange.id, doctor_who.id]
+    assert response.json[0].get('summary')[0].get('free_minutes') == 420
+    assert response.json[1].get('summary')[0].get('free_minutes') == 480
+
+    response = client.get(f'/doctors/availability_summary?doctor_ids=999&from=2024-01-01T00:00:00&to=2024-01-02T00:00:00')
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+# Test create_appointment endpoint during the lunch break of a split schedule
+def test_create_appointment_during_lunch_break(client, doctor_strange, dr_strange_split_working_hours):
+    response = client.post(f'/doctors/{doctor_strange.id}/appointments', json={
+        'appointment_starts_at': '2024-01-01T11:30:00',
+        'appointment_ends_at': '2024-01-01T12:30:00',  # Overlaps with the lunch break
+    })
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert response.json == {'error': CANNOT_CREATE_APPOINTMENT_OUTSIDE_WORKING_HOURS_ERROR}
+
+    response = client.post(f'/doctors/{doctor_strange.id}/appointments', json={
+        'appointment_starts_at': '2024-01-01T13:00:00',
+        'appointment_ends_at': '2024-01-01T14:00:00',  # Inside the afternoon shift
+    })
+    assert response.status_code == HTTPStatus.CREATED
+
+
+# Test timestamps with a time zone offset are rejected, instead of failing to compare with the naive ones
+def test_time_zone_aware_datetimes(client, doctor_strange, dr_strange_working_hours, dr_strange_appointment):
+    response = client.post(f'/doctors/{doctor_strange.id}/appointments', json={
+        'appointment_starts_at': '2024-01-01T10:00:00+00:00',
+        'appointment_ends_at': '2024-01-01T10:30:00+00:00',
+    })
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert response.json == {'error': TIMEZONE_AWARE_DATETIME_ERROR}
+
+    response = client.get('/appointments/first_available?start_time=2024-01-01T10:00:00%2B00:00')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+    response = client.get(f'/doctors/{doctor_strange.id}/availability_summary?from=2024-01-01T00:00:00&to=2024-01-02T00:00:00Z')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+# Test find first available appointment skips the lunch break when the morning shift is full
+def test_find_first_available_appointment_split_schedule(client, doctor_strange, dr_strange_split_working_hours):
+    response = client.get(f'/appointments/first_available?start_time=2024-01-01T11:00:00&appointment_length_minutes=90')
+    assert response.status_code == HTTPStatus.OK
+    assert response.json.get('start_time') == '2024-01-01T13:00:00'
+    assert response.json.get('end_time') == '2024-01-01T14:30:00'
+
+
+# Test find first available appointment does not return slots before the requested start time
+def test_find_first_available_appointment_starting_mid_day(client, doctor_strange, dr_strange_working_hours, dr_strange_appointment):
+    response = client.get(f'/appointments/first_available?start_time=2024-01-01T10:05:00')
+    assert response.status_code == HTTPStatus.OK
+    assert response.json.get('start_time') == '2024-01-01T10:15:00'  # Slots are every 15 minutes from the start of the shift
+
+
+# Test availability summary with a split schedule
+def test_availability_summary_split_schedule(client, doctor_strange, dr_strange_split_working_hours):
+    response = client.get(f'/doctors/{doctor_strange.id}/availability_summary?from=2024-01-01T00:00:00&to=2024-01-02T00:00:00')
+    assert response.status_code == HTTPStatus.OK
+    summary = response.json.get('summary')
+    assert summary[0].get('working_minutes') == 420
+    assert summary[0].get('longest_free_gap_minutes') == 240
+
+
+# Test events stream publishes the created appointments, resuming from the Last-Event-ID header
+def test_events_stream_appointment_created(client, doctor_strange, dr_strange_working_hours):
+    from src.extensions import events
+    last_event_id = events.last_event_id
+
+    response = client.post(f'/doctors/{doctor_strange.id}/appointments', json={
+        'appointment_starts_at': '2024-01-01T10:30:00',
+        'appointment_ends_at': '2024-01-01T11:00:00',
+    })
+    assert response.status_code == HTTPStatus.CREATED
+
+    response = client.get('/events', headers={'Last-Event-ID': str(last_event_id)}, buffered=False)
+    assert response.status_code == HTTPStatus.OK
+    assert response.mimetype == 'text/event-stream'
+    message = next(response.response).decode()
+    response.close()
+    assert message.startswith(f'id: {last_event_id + 1}\nevent: appointment.created\n')
+    assert '"start_time": "2024-01-01T10:30:00"' in message
+    assert f'"doctor_id": {doctor_strange.id}' in message
+
+
+# Test events stream only sends the events of the requested doctor
+def test_events_stream_filtered_by_doctor(client, doctor_strange, doctor_who, dr_strange_working_hours, dr_who_working_hours):
+    from src.extensions import events
+    last_event_id = events.last_event_id
+
+    for doctor in (doctor_who, doctor_strange):
+        response = client.post(f'/doctors/{doctor.id}/appointments', json={
+            'appointment_starts_at': '2024-01-01T10:30:00',
+            'appointment_ends_at': '2024-01-01T11:00:00',
+        })
+        assert response.status_code == HTTPStatus.CREATED
+
+    response = client.get(f'/events?doctor_id={doctor_strange.id}', headers={'Last-Event-ID': str(last_event_id)}, buffered=False)
+    message = next(response.response).decode()
+    response.close()
+    assert message.startswith(f'id: {last_event_id + 2}\n')
+
+
+# Test events broker tells subscribers resuming from an event that is no longer buffered to reset their state
+def test_events_broker_resume_after_dropped_events():
+    from src.events import EventBroker
+    broker = EventBroker(max_events=2)
+    for i in range(5):
+        broker.publish('appointment.created', 1, {'id': i})
+
+    stream = broker.subscribe(last_event_id=1)
+    assert next(stream).startswith('id: 3\nevent: stream.reset\n')
+    assert next(stream).startswith('id: 4\nevent: appointment.created\n')
+    assert next(stream).startswith('id: 5\nevent: appointment.created\n')
+
+
+# Test events broker tells subscribers resuming from an event of a previous process, i.e. with a higher id, to reset their state
+def test_events_broker_resume_after_restart():
+    from src.events import EventBroker
+    broker = EventBroker()
+    broker.publish('appointment.created', 1, {'id': 1})
+
+    stream = broker.subscribe(last_event_id=500)
+    assert next(stream).startswith('id: 1\nevent: stream.reset\n')
+    broker.publish('appointment.created', 1, {'id': 2})
+    assert next(stream).startswith('id: 2\nevent: appointment.created\n')
+
+
+# Test the query budget fails when an endpoint issues more queries than declared
+def test_query_budget_exceeded(client, query_budget, doctor_strange, dr_strange_working_hours):
+    with pytest.raises(AssertionError, match='the budget is 1'):
+        with query_budget(max_queries=1):
+            client.post(f'/doctors/{doctor_strange.id}/appointments', json={
+                'appointment_starts_at': '2024-01-01T10:30:00',
+                'appointment_ends_at': '2024-01-01T11:00:00',
+            })
+
+
+# Test import-appointments command imports the valid rows and reports the rejected ones
+def test_import_appointments_command(app, tmp_path, doctor_strange, dr_strange_working_hours, dr_strange_appointment):
+    from src.models import Appointment
+    input_file = tmp_path / 'appointments.csv'
+    input_file.write_text(
+        'doctor_id,start_time,end_time,notes\n'
+        f'{doctor_strange.id},2024-01-01T10:00:00,2024-01-01T10:30:00,first visit\n'
+        f'{doctor_strange.id},2024-01-01T09:30:00,2024-01-01T10:00:00,\n'  # Conflicts with the existing appointment
+        f'{doctor_strange.id},2024-01-02T09:00:00,2024-01-02T10:00:00,\n'
+        f'{doctor_strange.id},2024-01-02T09:30:00,2024-01-02T10:30:00,\n'  # Conflicts with the previous row
+        f'{doctor_strange.id},2024-01-06T09:00:00,2024-01-06T10:00:00,\n'  # Saturday
+        f'999,2024-01-03T09:00:00,2024-01-03T10:00:00,\n'
+        f'{doctor_strange.id},not a date,2024-01-03T10:00:00,\n'
+        f'{doctor_strange.id},2024-01-01T11:00:00+00:00,2024-01-01T11:30:00+00:00,\n'
+    )
+    rejects_file = tmp_path / 'rejects.ndjson'
+
+    result = app.test_cli_runner().invoke(args=['import-appointments', str(input_file), '--chunk-size', '3', '--rejects', str(rejects_file)])
+    assert result.exit_code == 0, result.output
+    assert 'Done: 2 imported, 6 rejected' in result.output
+    assert Appointment.query.count() == 3
+
+    rejects = {reject['line']: reject['error'] for reject in map(json.loads, rejects_file.read_text().splitlines())}
+    assert rejects == {
+        3: CANNOT_CREATE_APPOINTMENT_CONFLIT_ERROR,
+        5: CANNOT_CREATE_APPOINTMENT_CONFLIT_ERROR,
+        6: CANNOT_CREATE_APPOINTMENT_OUTSIDE_WORKING_HOURS_ERROR,
+        7: DOCTOR_NOT_FOUND_ERROR,
+        8: "Invalid row. ValueError: Invalid isoformat string: 'not a date'",
+        9: 'Invalid row. times must not have a time zone offset',
+    }
+
+    # A malformed NDJSON line is rejected, the lines around it are still imported
+    input_file = tmp_path / 'appointments.ndjson'
+    input_file.write_text(
+        json.dumps({'doctor_id': doctor_strange.id, 'start_time': '2024-01-03T09:00:00', 'end_time': '2024-01-03T10:00:00'}) + '\n'
+        + '{"doctor_id": 1, "start_time": "2024-01-03T1\n'
+        + json.dumps({'doctor_id': doctor_strange.id, 'start_time': '2024-01-04T09:00:00', 'end_time': '2024-01-04T10:00:00'}) + '\n'
+    )
+
+    result = app.test_cli_runner().invoke(args=['import-appointments', str(input_file), '--chunk-size', '1', '--rejects', str(rejects_file)])
+    assert result.exit_code == 0, result.output
+    assert 'Done: 2 imported, 1 rejected' in result.output
+    [reject] = map(json.loads, rejects_file.read_text().splitlines())
+    assert reject['line'] == 2
+    assert reject['row'] == {'line': '{"doctor_id": 1, "start_time": "2024-01-03T1'}
+    assert reject['error'].startswith('Invalid row. JSONDecodeError: ')
+
+
+# Test the import commands and the server share the database configured through the environment
+def test_import_appointments_command_database_from_environment(tmp_path, monkeypatch):
+    from src.app import create_app
+    from src.models import Appointment
+    monkeypatch.setenv('FLASK_SQLALCHEMY_DATABASE_URI', f'sqlite:///{tmp_path / "db.sqlite"}')
+    input_file = tmp_path / 'appointments.csv'
+    input_file.write_text('doctor_id,start_time,end_time\n1,2024-01-01T10:00:00,2024-01-01T10:30:00\n')
+
+    result = create_app().test_cli_runner().invoke(args=['import-appointments', str(input_file)])
+    assert result.exit_code == 0, result.output
+
+    app = create_app()  # i.e. the server, started after the import
+    with app.app_context():
+        assert Appointment.query.count() == 1
+
+
+# Test import-working-hours command with a NDJSON file
+def test_import_working_hours_command(app, tmp_path, doctor_strange, dr_strange_working_hours):
+    from src.models import WorkingHours
+    input_file = tmp_path / 'working_hours.ndjson'
+    input_file.write_text('\n'.join(json.dumps(row) for row in [
+        {'doctor_id': doctor_strange.id, 'day_of_the_week': 5, 'start_time': '09:00', 'end_time': '12:00'},
+        {'doctor_id': doctor_strange.id, 'day_of_the_week': 0, 'start_time': '09:00', 'end_time': '12:00'},  # Already exists
+        {'doctor_id': doctor_strange.id, 'day_of_the_week': 6, 'start_time': '12:00', 'end_time': '09:00'},
+    ]))
+
+    result = app.test_cli_runner().invoke(args=['import-working-hours', str(input_file)])
+    assert result.exit_code == 0, result.output
+    assert 'Done: 1 imported, 2 rejected' in result.output
+    assert WorkingHours.query.filter_by(day_of_the_week=5).count() == 1
+
+
+# Test find first available series, the third occurrence of the earliest single slot is already booked
+def test_find_first_available_series(client, doctor_strange, dr_strange_working_hours, dr_strange_appointment):
+    response = client.post(f'/doctors/{doctor_strange.id}/appointments', json={
+        'appointment_starts_at': '2024-01-15T10:00:00',
+        'appointment_ends_at': '2024-01-15T11:00:00',
+    })
+    assert response.status_code == HTTPStatus.CREATED
+
+    response = client.get(
+        f'/doctors/{doctor_strange.id}/appointments/first_available_series?start_time=2024-01-01T00:00:00&appointment_length_minutes=45&occurrences=3'
+    )
+    assert response.status_code == HTTPStatus.OK
+    assert response.json.get('start_time') == '2024-01-01T11:00:00'
+    assert response.json.get('end_time') == '2024-01-01T11:45:00'
+    assert [occurrence.get('start_time') for occurrence in response.json.get('occurrences')] == [
+        '2024-01-01T11:00:00', '2024-01-08T11:00:00', '2024-01-15T11:00:00'
+    ]
+
+
+# Test find first available series when the doctor is fully booked
+def test_find_first_available_series_full_schedule(client, doctor_strange, dr_strange_working_hours, dr_strange_month_full_of_appointments):
+    response = client.get(f'/doctors/{doctor_strange.id}/appointments/first_available_series?start_time=2024-01-01T00:00:00&occurrences=2')
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+# Test create appointment series books every occurrence
+def test_create_appointment_series(client, doctor_strange, dr_strange_working_hours, dr_strange_appointment):
+    response = client.post(f'/doctors/{doctor_strange.id}/appointments/series', json={
+        'appointment_starts_at': '2024-01-01T10:00:00',
+        'appointment_ends_at': '2024-01-01T10:45:00',
+        'occurrences': 10,
+    })
+    assert response.status_code == HTTPStatus.CREATED
+    assert len(response.json) == 10
+    assert response.json[-1].get('start_time') == '2024-03-04T10:00:00'
+
+
+# Test create appointment series books nothing if one of the occurrences conflicts
+def test_create_appointment_series_conflict(client, doctor_strange, dr_strange_working_hours, dr_strange_appointment):
+    response = client.post(f'/doctors/{doctor_strange.id}/appointments/series', json={
+        'appointment_starts_at': '2023-12-18T09:00:00',
+        'appointment_ends_at': '2023-12-18T09:30:00',
+        'occurrences': 4,
+    })
+    assert response.status_code == HTTPStatus.CONFLICT
+    assert response.json == {'error': CANNOT_CREATE_APPOINTMENT_CONFLIT_ERROR, 'occurrence_start_time': '2024-01-01T09:00:00'}
+
+    response = client.get(f'/doctors/{doctor_strange.id}/appointments?start_time=2023-12-01T00:00:00&end_time=2024-01-31T00:00:00')
+    assert len(response.json) == 1
+
+
+# Test series spanning more than a year are rejected, both when searching and when booking
+def test_appointment_series_too_long(client, doctor_strange, dr_strange_working_hours):
+    response = client.get(
+        f'/doctors/{doctor_strange.id}/appointments/first_available_series?start_time=2024-01-01T00:00:00&occurrences=52&interval_days=100000'
+    )
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert response.json == {'error': SERIES_TOO_LONG_ERROR.format(max_days=366)}
+
+    response = client.post(f'/doctors/{doctor_strange.id}/appointments/series', json={
+        'appointment_starts_at': '2024-01-01T10:00:00',
+        'appointment_ends_at': '2024-01-01T10:45:00',
+        'occurrences': 2,
+        'interval_days': 365,
+    })
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+# Test find first available appointment requiring two doctors at the same time
+def test_find_first_available_joint_appointment(
+    client, query_budget, doctor_strange, doctor_who, dr_strange_working_hours, dr_who_working_hours, dr_strange_appointment, dr_who_appointment
+):
+    response = client.post(f'/doctors/{doctor_who.id}/appointments', json={
+        'appointment_starts_at': '2024-01-01T10:00:00',
+        'appointment_ends_at': '2024-01-01T11:30:00',
+    })
+    assert response.status_code == HTTPStatus.CREATED
+
+    with query_budget(max_queries=FIRST_AVAILABLE_QUERY_BUDGET, max_time_ms=QUERY_TIME_BUDGET_MS):
+        response = client.get(
+            f'/appointments/first_available?start_time=2024-01-01T00:00:00&appointment_length_minutes=60&doctor_ids={doctor_strange.id}&doctor_ids={doctor_who.id}'
+        )
+    assert response.status_code == HTTPStatus.OK
+    assert response.json.get('start_time') == '2024-01-01T11:30:00'  # Both are busy from 9:00 to 10:00 and Dr Who until 11:30
+    assert response.json.get('end_time') == '2024-01-01T12:30:00'
+    assert response.json.get('doctor_ids') == [doctor_strange.id, doctor_who.id]
+
+
+# Test find first available appointment requiring a doctor that doesn't exist
+def test_find_first_available_joint_appointment_non_existing_doctor(client, doctor_strange, dr_strange_working_hours):
+    response = client.get(f'/appointments/first_available?start_time=2024-01-01T00:00:00&doctor_ids={doctor_strange.id}&doctor_ids=999')
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+# Test create joint appointment books every doctor
+def test_create_joint_appointment(client, query_budget, doctor_strange, doctor_who, dr_strange_working_hours, dr_who_working_hours):
+    with query_budget(max_queries=JOINT_APPOINTMENT_QUERY_BUDGET + 2, max_time_ms=QUERY_TIME_BUDGET_MS):  # Two doctors
+        response = client.post('/appointments/joint', json={
+            'doctor_ids': [doctor_strange.id, doctor_who.id],
+            'appointment_starts_at': '2024-01-01T10:00:00',
+            'appointment_ends_at': '2024-01-01T11:00:00',
+        })
+    assert response.status_code == HTTPStatus.CREATED
+    assert [appointment.get('doctor_id') for appointment in response.json] == [doctor_strange.id, doctor_who.id]
+
+
+# Test create joint appointment books nobody if one of the doctors isn't available
+def test_create_joint_appointment_conflict(client, doctor_strange, doctor_who, dr_strange_working_hours, dr_who_working_hours, dr_who_appointment):
+    response = client.post('/appointments/joint', json={
+        'doctor_ids': [doctor_strange.id, doctor_who.id],
+        'appointment_starts_at': '2024-01-01T09:30:00',
+        'appointment_ends_at': '2024-01-01T10:30:00',
+    })
+    assert response.status_code == HTTPStatus.CONFLICT
+    assert response.json == {'error': CANNOT_CREATE_APPOINTMENT_CONFLIT_ERROR, 'doctor_id': doctor_who.id}
+
+    response = client.get(f'/doctors/{doctor_strange.id}/appointments?start_time=2024-01-01T00:00:00&end_time=2024-01-01T23:59:59')
+    assert response.json == []
+
+
+# Test group commit validates and commits the concurrent bookings together, each of them getting its own result
+def test_group_commit_batches_bookings(group_commit_app):
+    from sqlalchemy import event
+    from src.extensions import db
+    commits = []
+    with group_commit_app.app_context():
+        event.listen(db.engine, 'commit', lambda conn: commits.append(conn))
+
+    group_committer = group_commit_app.extensions['group_commit']
+    futures = [
+        group_committer.submit(1, datetime(2024, 1, 1, 10), datetime(2024, 1, 1, 11)),
+        group_committer.submit(1, datetime(2024, 1, 1, 10, 30), datetime(2024, 1, 1, 11)),  # Conflicts with the first one
+        group_committer.submit(2, datetime(2024, 1, 1, 10), datetime(2024, 1, 1, 11)),
+        group_committer.submit(2, datetime(2024, 1, 1, 17), datetime(2024, 1, 1, 18)),  # Dr Who stops working at 16:00
+    ]
+    results = [future.result(timeout=5) for future in futures]
+
+    assert results[0][0].get('start_time') == '2024-01-01T10:00:00'
+    assert results[1] == (None, CANNOT_CREATE_APPOINTMENT_CONFLIT_ERROR)
+    assert results[2][0].get('doctor_id') == 2
+    assert results[3] == (None, CANNOT_CREATE_APPOINTMENT_OUTSIDE_WORKING_HOURS_ERROR)
+    assert len(commits) == 1
+
+
+# Test group commit is refused with an in memory database, whose single connection the worker would share with the requests
+def test_group_commit_in_memory_database():
+    from src.app import create_app
+    with pytest.raises(ValueError, match='GROUP_COMMIT_ENABLED'):
+        create_app(config={'GROUP_COMMIT_ENABLED': True})
+
+
+# Test create_appointment endpoint with group commit enabled, from concurrent clients
+def test_create_appointment_group_commit(group_commit_app):
+    payloads = [
+        {'appointment_starts_at': f'2024-01-01T{hour}:00:00', 'appointment_ends_at': f'2024-01-01T{hour}:30:00'} for hour in range(9, 17)
+    ] * 2  # Every slot is requested twice, only one of them can be booked
+
+    def book(payload):
+        with group_commit_app.test_client() as client:
+            return client.post('/doctors/1/appointments', json=payload)
+
+    with ThreadPoolExecutor(max_workers=len(payloads)) as executor:
+        responses = list(executor.map(book, payloads))
+
+    statuses = [response.status_code for response in responses]
+    assert statuses.count(HTTPStatus.CREATED) == 8
+    assert statuses.count(HTTPStatus.CONFLICT) == 8
+    with group_commit_app.test_client() as client:
+        response = client.get('/doctors/1/appointments?start_time=2024-01-01T00:00:00&end_time=2024-01-01T23:59:59')
+    assert len(response.json) == 8
+
+
+# Test group commit only fails the bad booking of a batch, the others are still booked
+def test_create_appointment_group_commit_bad_booking(group_commit_app, monkeypatch):
+    from concurrent.futures import Future
+    from datetime import timezone
+    from src.errors import CANNOT_PROCESS_APPOINTMENT_ERROR
+    group_committer = group_commit_app.extensions['group_commit']
+    # Can't be compared with the naive times of the rest of the batch, the endpoints reject it before it reaches the worker
+    bad_booking = group_committer.submit(1, datetime(2024, 1, 1, 9, tzinfo=timezone.utc), datetime(2024, 1, 1, 9, 30, tzinfo=timezone.utc))
+
+    def book(hour):
+        with group_commit_app.test_client() as client:
+            return client.post('/doctors/1/appointments', json={
+                'appointment_starts_at': f'2024-01-01T{hour}:00:00', 'appointment_ends_at': f'2024-01-01T{hour}:30:00'
+            })
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        responses = list(executor.map(book, range(10, 16)))
+    assert [response.status_code for response in responses] == [HTTPStatus.CREATED] * 6
+    with pytest.raises(TypeError):
+        bad_booking.result(timeout=5)
+
+    # The endpoint answers with an error instead of a 500 when the worker can't process the booking
+    failed = Future()
+    failed.set_exception(TypeError("can't compare offset-naive and offset-aware datetimes"))
+    monkeypatch.setattr(group_committer, 'submit', lambda *args: failed)
+    response = book(16)
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert response.json == {'error': CANNOT_PROCESS_APPOINTMENT_ERROR}
+
+
+# Test create_appointment endpoint with group commit enabled answers 503, without booking, instead of waiting forever for a slow or dead worker
+def test_create_appointment_group_commit_unavailable(group_commit_app):
+    from src.errors import CANNOT_CREATE_APPOINTMENT_UNAVAILABLE_ERROR
+    payload = {'appointment_starts_at': '2024-01-01T10:00:00', 'appointment_ends_at': '2024-01-01T10:30:00'}
+
+    group_commit_app.config['GROUP_COMMIT_TIMEOUT_SECONDS'] = 0.01  # Shorter than the window the worker waits for more bookings
+    with group_commit_app.test_client() as client:
+        response = client.post('/doctors/1/appointments', json=payload)
+    assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+    assert response.json == {'error': CANNOT_CREATE_APPOINTMENT_UNAVAILABLE_ERROR}
+
+    group_commit_app.extensions['group_commit'].close()  # Processes what's left in the queue, the cancelled booking is skipped
+    with group_commit_app.test_client() as client:
+        response = client.post('/doctors/1/appointments', json={**payload, 'appointment_starts_at': '2024-01-01T11:00:00', 'appointment_ends_at': '2024-01-01T11:30:00'})
+        assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+
+        response = client.get('/doctors/1/appointments?start_time=2024-01-01T00:00:00&end_time=2024-01-01T23:59:59')
+        assert response.json == []
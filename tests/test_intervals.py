@@ -0,0 +1,59 @@
+from src.intervals import contains, first_gap, intersect, iter_intersect, normalize, overlaps, subtract, union
+
+
+def test_normalize_merges_overlapping_and_adjacent_intervals():
+    assert normalize([(5, 7), (1, 3), (3, 4), (6, 9), (10, 10)]) == [(1, 4), (5, 9)]
+
+
+def test_union():
+    assert union([(1, 3), (8, 10)], [(2, 5), (10, 12)]) == [(1, 5), (8, 12)]
+    assert union([], [(1, 2)]) == [(1, 2)]
+
+
+def test_intersect():
+    assert intersect([(1, 5), (8, 12)], [(3, 9), (11, 20)]) == [(3, 5), (8, 9), (11, 12)]
+    assert intersect([(1, 2)], [(2, 3)]) == []
+
+
+def test_subtract():
+    assert subtract([(9, 17)], [(9, 10), (12, 13), (16, 18)]) == [(10, 12), (13, 16)]
+    assert subtract([(9, 12), (13, 17)], [(11, 14)]) == [(9, 11), (14, 17)]
+    assert subtract([(9, 17)], []) == [(9, 17)]
+
+
+def test_first_gap():
+    free = [(9, 10), (11, 14), (15, 20)]
+    assert first_gap(free, 2) == 11
+    assert first_gap(free, 2, not_before=13) == 15
+    assert first_gap(free, 1, not_before=12) == 12
+    assert first_gap(free, 6) is None
+
+
+def test_contains_and_overlaps():
+    shifts = [(9, 12), (13, 17)]
+    assert contains(shifts, (9, 12))
+    assert contains(shifts, (14, 15))
+    assert not contains(shifts, (11, 14))
+    assert not contains(shifts, (12, 13))
+    assert overlaps(shifts, (11, 14))
+    assert not overlaps(shifts, (12, 13))
+    assert not overlaps(shifts, (17, 18))
+
+
+def test_iter_intersect_is_lazy():
+    def stream(intervals, pulled):
+        for interval in intervals:
+            pulled.append(interval)
+            yield interval
+
+    pulled = []
+    common = iter_intersect(stream([(1, 4), (6, 10), (20, 30)], pulled), stream([(2, 3), (7, 12), (25, 26)], pulled), [(0, 100)])
+    assert next(common) == (2, 3)
+    assert next(common) == (7, 10)
+    assert (20, 30) not in pulled
+    assert list(common) == [(25, 26)]
+
+
+def test_first_gap_on_a_stream():
+    assert first_gap(iter_intersect([(1, 4), (6, 10)], [(2, 8)]), 2) == 2
+    assert first_gap(iter_intersect([(1, 4), (6, 10)], [(3, 7)]), 2) is None